@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import contextlib
+
+# Byte budget of a cache folder, least recently used entries are evicted beyond it
+CACHE_BYTES = 16 * 2**30
+CACHE_FOLDER = "cache"
+HASH_CHUNK_SIZE = 2**20
+ENTRY_FILENAME = "entry.json"  # source and params of an entry, to rebuild a damaged manifest
+TRASH_PREFIX = ".trash-"  # entry folders moved aside before deletion
+
+def _folder_bytes(folder):
+    num_bytes = 0
+    for root, _, files in os.walk(folder):
+        for filename in files:
+            num_bytes += os.path.getsize(os.path.join(root, filename))
+    return num_bytes
+
+def _umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+class DatasetCache:
+    """
+    Content-addressed cache of dataset builds with a JSON manifest
+
+    Entries are keyed by the content hash of the source file plus the build
+    parameters (generator, format version, ...), so an edited PGN or a bumped
+    version gets a new entry instead of silently reusing a stale one. Source
+    hashes are remembered by size and mtime to avoid rehashing unchanged files.
+
+    Training starts reader processes that open the cache at once, so writes of
+    the manifest hold a lock on manifest.lock and replace the manifest through
+    a temporary file of their own. Lookups never write it: a hit touches the
+    mtime of the entry folder, which eviction counts as its last use. Entries
+    are replaced and evicted by renaming their folder aside before deleting
+    it, so readers that already memory-mapped its files keep reading them
+    and no reader finds a folder with a mix of old and new files.
+    - manifest.json:
+        - files: {path: {size, mtime, sha1}}
+        - entries: {key: {source, params, bytes, last_used}}
+    """
+    def __init__(self, folder, max_bytes=CACHE_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.filename_manifest = os.path.join(folder, "manifest.json")
+        self.filename_lock = os.path.join(folder, "manifest.lock")
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Holds an exclusive lock on the manifest across processes, for read-modify-write
+        """
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder, exist_ok=True)
+        with open(self.filename_lock, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load_manifest(self):
+        if not os.path.isfile(self.filename_manifest):
+            return {"files": {}, "entries": {}}
+        try:
+            with open(self.filename_manifest) as f:
+                return json.load(f)
+        except ValueError:
+            print("Rebuilding damaged cache manifest " + self.filename_manifest)
+            return self.rebuild_manifest()
+
+    def rebuild_manifest(self):
+        """
+        Returns a manifest of the entries on disk, from the entry file written by add
+        """
+        manifest = {"files": {}, "entries": {}}
+        for key in os.listdir(self.folder):
+            if key.startswith(TRASH_PREFIX):
+                continue
+            try:
+                with open(os.path.join(self.entry_folder(key), ENTRY_FILENAME)) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue
+            entry["bytes"] = _folder_bytes(self.entry_folder(key))
+            entry["last_used"] = os.path.getmtime(self.entry_folder(key))
+            manifest["entries"][key] = entry
+        return manifest
+
+    def save_manifest(self, manifest):
+        """
+        Replaces the manifest atomically, callers hold the lock
+        """
+        fd, filename_tmp = tempfile.mkstemp(dir=self.folder, prefix="manifest.", suffix=".tmp")
+        try:
+            # mkstemp creates the file readable by its owner only
+            os.fchmod(fd, 0o666 & ~_umask())
+            with os.fdopen(fd, "w") as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            os.replace(filename_tmp, self.filename_manifest)
+        except:
+            os.remove(filename_tmp)
+            raise
+
+    def source_hash(self, filename):
+        """
+        Returns the sha1 of the file contents, rehashing only if its size or mtime changed
+        """
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        record = self.load_manifest()["files"].get(path)
+        if record is not None and record["size"] == stat.st_size and record["mtime"] == stat.st_mtime:
+            return record["sha1"]
+
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                sha1.update(chunk)
+        with self.locked():
+            manifest = self.load_manifest()
+            manifest["files"][path] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha1": sha1.hexdigest()}
+            self.save_manifest(manifest)
+        return sha1.hexdigest()
+
+    def key(self, source, params):
+        return hashlib.sha1((source + json.dumps(params, sort_keys=True)).encode()).hexdigest()
+
+    def entry_folder(self, key):
+        return os.path.join(self.folder, key)
+
+    def lookup(self, source, candidates):
+        """
+        Returns (folder, params) of the first candidate params with an entry, or (None, None)
+        - candidates: build params in order of preference, e.g. the exact
+                      build first and then compatible supersets
+        """
+        manifest = self.load_manifest()
+        for params in candidates:
+            key = self.key(source, params)
+            if key in manifest["entries"] and os.path.isdir(self.entry_folder(key)):
+                try:
+                    os.utime(self.entry_folder(key))
+                except OSError:
+                    pass
+                return self.entry_folder(key), params
+        return None, None
+
+    def create(self, source, params):
+        """
+        Returns an empty folder for a new entry, replacing any previous build of it
+        - the entry is dropped from the manifest until add, so lookups miss it
+          while it is being built
+        """
+        key = self.key(source, params)
+        with self.locked():
+            manifest = self.load_manifest()
+            if manifest["entries"].pop(key, None) is not None:
+                self.save_manifest(manifest)
+            self.discard(key)
+            os.makedirs(self.entry_folder(key))
+        return self.entry_folder(key)
+
+    def discard(self, key):
+        """
+        Deletes the folder of an entry after renaming it aside, callers hold the lock
+        - open and memory-mapped files of the entry stay valid for their readers
+        """
+        folder = self.entry_folder(key)
+        if os.path.exists(folder):
+            folder_trash = tempfile.mkdtemp(dir=self.folder, prefix=TRASH_PREFIX + key + ".")
+            os.replace(folder, folder_trash)
+            shutil.rmtree(folder_trash, ignore_errors=True)
+
+    def add(self, source, params):
+        """
+        Records the entry built in its folder and evicts least recently used entries over budget
+        """
+        key = self.key(source, params)
+        with open(os.path.join(self.entry_folder(key), ENTRY_FILENAME), "w") as f:
+            json.dump({"source": source, "params": params}, f, indent=2, sort_keys=True)
+        with self.locked():
+            manifest = self.load_manifest()
+            manifest["entries"][key] = {
+                "source": source,
+                "params": params,
+                "bytes": _folder_bytes(self.entry_folder(key)),
+                "last_used": time.time()
+            }
+            self.evict(manifest, keep=key)
+            self.save_manifest(manifest)
+
+    def evict(self, manifest, keep=None):
+        """
+        Deletes least recently used entries until the cache fits in max_bytes
+        """
+        entries = manifest["entries"]
+        for key in [key for key in entries if not os.path.isdir(self.entry_folder(key))]:
+            del entries[key]
+        # Left behind by a process that died while deleting an entry
+        for name in os.listdir(self.folder):
+            if name.startswith(TRASH_PREFIX):
+                shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+        # Lookups record their use in the folder mtime
+        for key, entry in entries.items():
+            entry["last_used"] = max(entry["last_used"], os.path.getmtime(self.entry_folder(key)))
+
+        num_bytes = sum(entry["bytes"] for entry in entries.values())
+        for key in sorted(entries, key=lambda key: entries[key]["last_used"]):
+            if num_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            print("Evicting cache entry " + key)
+            self.discard(key)
+            num_bytes -= entries[key]["bytes"]
+            del entries[key]
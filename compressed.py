@@ -0,0 +1,266 @@
+import os
+import bz2
+import gzip
+import lzma
+import zlib
+import bisect
+import queue
+import threading
+
+# Decompressors by file extension, each opened as opener(filename, mode)
+OPENERS = {
+    ".gz": gzip.open,
+    ".bz2": bz2.open,
+    ".xz": lzma.open
+}
+
+CHUNK_SIZE = 2**20
+MAX_CHUNKS = 16  # decompressed chunks buffered ahead of the parser
+POLL_TIMEOUT = 0.1
+CHECKPOINT_BYTES = 2**22  # decompressed bytes between gzip restart checkpoints, each holds ~40KB of inflate state
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Restart checkpoints of gzip files decompressed in this process, recorded by
+# every pass over the file including indexing
+# - (path, size, mtime): sorted list of (offset, compressed offset, decompressor)
+_checkpoints = {}
+_checkpoints_lock = threading.Lock()
+
+def compression(filename):
+    """
+    Returns the compression extension of the file, None if uncompressed
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    return ext if ext in OPENERS else None
+
+def strip_compression(filename):
+    """
+    Returns the filename without its compression extension
+    """
+    return os.path.splitext(filename)[0] if compression(filename) else filename
+
+def open_input(filename, binary=False):
+    """
+    Opens a plain or compressed (.gz, .bz2, .xz) file for reading
+    - compressed files are decompressed in a background thread
+    - binary: return bytes lines instead of str
+    """
+    if compression(filename) is None:
+        return open(filename, "rb" if binary else "r")
+    return ThreadedDecompressor(filename, binary=binary)
+
+def seekable(filename):
+    """
+    Returns whether open_input can seek backwards in the file without
+    decompressing it again from the start, true for plain and gzip files
+    """
+    return compression(filename) in (None, ".gz")
+
+def require_seekable(filename, reason):
+    """
+    Raises ValueError if the file cannot seek backwards cheaply
+    """
+    if not seekable(filename):
+        raise ValueError(reason + " needs random access, which " + compression(filename) + \
+                         " files do not support: decompress " + filename + " or recompress it with gzip")
+
+def open_output(filename):
+    """
+    Opens a plain or compressed text file for writing, compressed by its extension
+    """
+    ext = compression(filename)
+    if ext is None:
+        return open(filename, "w")
+    return OPENERS[ext](filename, "wt")
+
+def _gzip_checkpoints(filename):
+    """
+    Returns the checkpoint list of the gzip file, starting with one at offset 0
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    with _checkpoints_lock:
+        if key not in _checkpoints:
+            _checkpoints[key] = [(0, 0, zlib.decompressobj(GZIP_WBITS))]
+        return _checkpoints[key]
+
+def _put(q, stop, item):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=POLL_TIMEOUT)
+            return
+        except queue.Full:
+            pass
+
+def _decompress_gzip(filename, q, stop, checkpoint):
+    """
+    Decompresses a gzip file from a checkpoint with zlib, recording a copy of
+    the decompressor every CHECKPOINT_BYTES so that seeks can restart there
+    """
+    try:
+        offset, offset_compressed, decompressor = checkpoint
+        decompressor = decompressor.copy()
+        checkpoints = _gzip_checkpoints(filename)
+        with open(filename, "rb") as f:
+            f.seek(offset_compressed)
+            pending = b""
+            while not stop.is_set():
+                if not pending:
+                    pending = f.read(CHUNK_SIZE)
+                    if not pending:
+                        _put(q, stop, b"")
+                        break
+                chunk = decompressor.decompress(pending, CHUNK_SIZE)
+                if decompressor.eof:
+                    # Concatenated gzip members continue the stream
+                    pending = decompressor.unused_data
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+                else:
+                    pending = decompressor.unconsumed_tail
+                offset += len(chunk)
+                with _checkpoints_lock:
+                    if offset >= checkpoints[-1][0] + CHECKPOINT_BYTES:
+                        checkpoints.append((offset, f.tell() - len(pending), decompressor.copy()))
+                if chunk:
+                    _put(q, stop, chunk)
+    except Exception as e:
+        q.put(e)
+
+def _decompress(filename, q, stop):
+    try:
+        with OPENERS[compression(filename)](filename, "rb") as f:
+            while not stop.is_set():
+                chunk = f.read(CHUNK_SIZE)
+                while not stop.is_set():
+                    try:
+                        q.put(chunk, timeout=POLL_TIMEOUT)
+                        break
+                    except queue.Full:
+                        pass
+                if not chunk:
+                    break
+    except Exception as e:
+        q.put(e)
+
+class ThreadedDecompressor:
+    """
+    Line reader over a compressed file with decompression in a background thread
+
+    The thread decompresses ahead into a bounded queue while the caller
+    parses. Offsets are positions in the decompressed stream, the same as
+    those of the game index, so seek() works with index offsets: forward
+    seeks skip decompressed data. Gzip files restart a seek from the nearest
+    checkpoint before the offset, so random access costs at most
+    CHECKPOINT_BYTES of decompression once the file was read past it in
+    this process, e.g. by indexing. Other formats restart backward seeks
+    from the start of the file, see require_seekable.
+    """
+    def __init__(self, filename, binary=False):
+        self.filename = filename
+        self.binary = binary
+        self.gzip = compression(filename) == ".gz"
+        self.thread = None
+        self._restart()
+
+    def _checkpoint(self, offset):
+        """
+        Returns the last gzip checkpoint at or before the offset
+        """
+        checkpoints = _gzip_checkpoints(self.filename)
+        with _checkpoints_lock:
+            i = bisect.bisect_right([checkpoint[0] for checkpoint in checkpoints], offset) - 1
+            return checkpoints[i]
+
+    def _restart(self, offset=0):
+        self.close()
+        self.queue = queue.Queue(MAX_CHUNKS)
+        self.stop = threading.Event()
+        if self.gzip:
+            checkpoint = self._checkpoint(offset)
+            target, args = _decompress_gzip, (self.filename, self.queue, self.stop, checkpoint)
+        else:
+            checkpoint = (0,)
+            target, args = _decompress, (self.filename, self.queue, self.stop)
+        self.thread = threading.Thread(target=target, args=args)
+        self.thread.daemon = True
+        self.thread.start()
+        # buffer[pos] is at offset base + pos of the decompressed stream
+        self.buffer = b""
+        self.pos = 0
+        self.base = checkpoint[0]
+        self.eof = False
+
+    def _fill(self):
+        """
+        Appends the next decompressed chunk to the buffer, returns False at EOF
+        """
+        if self.eof:
+            return False
+        chunk = self.queue.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        if not chunk:
+            self.eof = True
+            return False
+        self.base += self.pos
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def tell(self):
+        return self.base + self.pos
+
+    def seek(self, offset):
+        if offset < self.tell() or (self.gzip and self._checkpoint(offset)[0] > self.tell() + CHECKPOINT_BYTES):
+            self._restart(offset)
+        while self.base + len(self.buffer) < offset:
+            # Drop the skipped data before decompressing more
+            self.pos = len(self.buffer)
+            if not self._fill():
+                break
+        self.pos = min(offset - self.base, len(self.buffer))
+        return self.tell()
+
+    def readline(self):
+        end = self.buffer.find(b"\n", self.pos)
+        while end < 0:
+            start = len(self.buffer) - self.pos
+            if not self._fill():
+                end = len(self.buffer) - 1
+                break
+            end = self.buffer.find(b"\n", start)
+        line = self.buffer[self.pos:end+1]
+        self.pos = end + 1
+        if self.binary:
+            return line
+        # Translate newlines like open() in text mode
+        return line.decode("utf-8", "replace").replace("\r\n", "\n")
+
+    def read(self):
+        while self._fill():
+            pass
+        data = self.buffer[self.pos:]
+        self.pos = len(self.buffer)
+        return data if self.binary else data.decode("utf-8", "replace").replace("\r\n", "\n")
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,11 +1,20 @@
 import sys
+import os
+import json
+import functools
+import hashlib
 import random
+import multiprocessing
 import chess
-import chess.pgn
+import chess.polyglot
 import numpy as np
 import itertools
 from tqdm import tqdm
 import re
+import pgn_index
+import pgn_reader
+import cache
+import compressed
 
 NUM_PIECES = len(chess.PIECE_TYPES)
 NUM_COLORS = len(chess.COLORS)
@@ -28,165 +37,214 @@ def np_flip(m, axis):
                          % (axis, m.ndim))
     return m[tuple(indexer)]
 
-def flip_state(state):
-    num_axes = len(state.shape)
-    # state = np_flip(state, num_axes-1)
-    state = np_flip(state, num_axes-2)
-    # Swap first six rows with last six rows
-    state[[0,1,2,3,4,5,6,7,8,9,10,11]] = state[[6,7,8,9,10,11,0,1,2,3,4,5]]
-    if state.shape[0] > 12:
-        idx_start_layer = 12
-        num_quad_layers = (state.shape[0] - idx_start_layer) // 4
-        for i in range(num_quad_layers):
-            idx = 4*i + idx_start_layer
-            state[[idx+0,idx+3]] = state[[idx+3,idx+0]]
-            state[[idx+1,idx+2]] = state[[idx+2,idx+1]]
-        idx_start_layer += 4*num_quad_layers
-        num_pair_layers = (state.shape[0] - idx_start_layer) // 2
-        for i in range(num_pair_layers):
-            idx = 2*i + idx_start_layer
-            state[[idx+0,idx+1]] = state[[idx+1,idx+0]]
-    return state
+@functools.lru_cache()
+def flip_permutation(num_channels):
+    """
+    Returns the channel permutation that swaps colors of a [C x 8 x 8] state
+    - 12 piece planes: white and black pieces swap
+    - groups of 4 attack planes: reversed (white/black attacker and defender swap)
+    - remaining pairs: swapped (e.g. white/black occupancy)
+    """
+    perm = list(range(num_channels))
+    perm[:12] = perm[6:12] + perm[:6]
+    idx_start_layer = 12
+    num_quad_layers = (num_channels - idx_start_layer) // 4
+    for i in range(num_quad_layers):
+        idx = 4*i + idx_start_layer
+        perm[idx:idx+4] = perm[idx:idx+4][::-1]
+    idx_start_layer += 4*num_quad_layers
+    num_pair_layers = (num_channels - idx_start_layer) // 2
+    for i in range(num_pair_layers):
+        idx = 2*i + idx_start_layer
+        perm[idx:idx+2] = perm[idx:idx+2][::-1]
+    return np.array(perm, dtype=np.intp)
+
+def flip_state(state, out=None):
+    """
+    Flips states [... x C x 8 x 8] to the other color's perspective in one gather
+    - rows are reversed as a view and channels are permuted by flip_permutation
+    - out: array to gather into, a new array if None
+    """
+    perm = flip_permutation(state.shape[-3])
+    return np.take(state[...,::-1,:], perm, axis=-3, out=out)
+
+# Lookup table from a byte (one rank of a bitboard) to its 8 squares, a-file first
+BYTE_TO_RANK = np.unpackbits(np.arange(256, dtype=np.uint8).reshape(-1, 1), axis=1)[:, ::-1].copy()
+
+PIECE_BITBOARDS = ("pawns", "knights", "bishops", "rooks", "queens", "kings")
+
+def _piece_bitboards(board, black=False):
+    """
+    Returns the 12 piece bitboards as ints, with colors swapped if black
+    """
+    pieces = [getattr(board, piece) for piece in PIECE_BITBOARDS]
+    white = board.occupied_co[chess.WHITE]
+    black_pieces = board.occupied_co[chess.BLACK]
+    if black:
+        white, black_pieces = black_pieces, white
+    return [p & white for p in pieces] + [p & black_pieces for p in pieces]
+
+def bitboards_from_board(board, black=False):
+    """
+    Returns the 12 piece bitboards of the board as np.uint64 in state channel order
+    - piece order: wp wn wb wr wq wk bp bn bb br bq bk
+    - black: swap colors and mirror the ranks to view the board from black's side
+    """
+    bitboards = np.array(_piece_bitboards(board, black=black), dtype=np.uint64)
+    if black:
+        # Byte i of a bitboard holds rank i, so mirroring the ranks is a byte swap
+        bitboards = bitboards.byteswap()
+    return bitboards
+
+def bitboards_from_boards(boards, black=False):
+    """
+    Returns the piece bitboards of a list of boards as np.uint64 [N x 12]
+    - black: bool or per-board list of bools
+    """
+    black = np.broadcast_to(np.asarray(black, dtype=bool), (len(boards),))
+    bitboards = np.array([_piece_bitboards(board, black=b) for board, b in zip(boards, black)], dtype=np.uint64)
+    bitboards = bitboards.reshape(len(boards), NUM_COLORS * NUM_PIECES)
+    bitboards[black] = bitboards[black].byteswap()
+    return bitboards
+
+def planes_from_bitboards(bitboards):
+    """
+    Expands bitboards of shape (..., K) into uint8 planes of shape (..., K, 8, 8)
+    """
+    bitboards = np.ascontiguousarray(bitboards, dtype="<u8")
+    ranks = bitboards.view(np.uint8).reshape(bitboards.shape + (NUM_ROWS,))
+    return BYTE_TO_RANK[ranks]
 
 def state_from_board(board, hashable=False, featurized=False, black=False):
     if featurized:
-        phi = featurized_state_from_board(board)
-        if black:
-            phi = flip_state(phi)
-        return phi
+        phi = np.empty((1, NUM_FEATURE_CHANNELS, NUM_ROWS, NUM_COLS))
+        return featurize_boards([board], black=black, out=phi)[0]
 
+    planes = planes_from_bitboards(bitboards_from_board(board, black=black))
     if not hashable:
-        state = np.zeros((NUM_COLORS * NUM_PIECES, NUM_ROWS, NUM_COLS))
-        for piece_type in chess.PIECE_TYPES:
-            for color in chess.COLORS:
-                pieces = bin(board.pieces(piece_type, color))
-                for i, piece in enumerate(reversed(pieces)):
-                    if piece == 'b':
-                        break
-                    elif piece == '1':
-                        row = i // NUM_ROWS
-                        col = i % NUM_ROWS
-                        state[(1-color)*NUM_PIECES + piece_type - 1, row, col] = 1
-        if black:
-            state = flip_state(state)
+        state = planes.astype(np.float64)
     else:
-        # TODO: black state
-        state = [0] * NUM_SQUARES
-        for piece_type in chess.PIECE_TYPES:
-            for color in chess.COLORS:
-                pieces = bin(board.pieces(piece_type, color))
-                for i, piece in enumerate(reversed(pieces)):
-                    if piece == 'b':
-                        break
-                    elif piece == '1':
-                        if black:
-                            row = NUM_ROWS-1 - (i // NUM_ROWS)
-                            col = i % NUM_ROWS
-                            state[row*NUM_ROWS + col] = color*NUM_PIECES + piece_type
-                        else:
-                            state[i] = (1-color)*NUM_PIECES + piece_type
-        state = tuple(state)
+        # Square values: 0 empty, 1-12 piece channel + 1
+        piece_ids = np.arange(1, NUM_COLORS * NUM_PIECES + 1)
+        state = tuple(piece_ids.dot(planes.reshape(-1, NUM_SQUARES)).tolist())
     return state
 
-def featurized_state_from_board(board):
-    def bitmap_to_array(bitmap):
-        bitmap = bin(bitmap)[2:].zfill(NUM_SQUARES)
-        return np.array([int(i) for i in reversed(bitmap)]).reshape(NUM_ROWS, NUM_COLS)
-
-    def get(arr, idx):
-        try:
-            return arr[idx]
-        except:
-            return 0
+def _ray_masks(direction):
+    """
+    Returns the bitboard of squares reached from each square by sliding in direction
+    """
+    masks = []
+    for square in range(NUM_SQUARES):
+        row = square // NUM_COLS + direction[0]
+        col = square % NUM_COLS + direction[1]
+        mask = 0
+        while 0 <= row < NUM_ROWS and 0 <= col < NUM_COLS:
+            mask |= 1 << (row * NUM_COLS + col)
+            row += direction[0]
+            col += direction[1]
+        masks.append(mask)
+    return masks
+
+# Slider rays as (masks, ascending) where ascending rays meet their nearest
+# blocker at the lowest set bit and descending rays at the highest
+ROOK_RAYS = tuple((_ray_masks(d), d[0] > 0 or (d[0] == 0 and d[1] > 0)) \
+                  for d in ((1,0), (0,1), (-1,0), (0,-1)))
+BISHOP_RAYS = tuple((_ray_masks(d), d[0] > 0) \
+                    for d in ((1,1), (-1,1), (-1,-1), (1,-1)))
+
+# (piece channel, rays) for the rook, bishop and queen feature planes
+SLIDERS = ((chess.ROOK - 1, ROOK_RAYS),
+           (chess.BISHOP - 1, BISHOP_RAYS),
+           (chess.QUEEN - 1, ROOK_RAYS + BISHOP_RAYS))
+NUM_SLIDER_PLANES = 4 * len(SLIDERS)
+
+NUM_FEATURE_CHANNELS = NUM_COLORS * NUM_PIECES + NUM_SLIDER_PLANES + 3
+
+def slider_attacks(bitboards, indices=None, offset=0):
+    """
+    Returns flat (plane * 64 + square) indices of every slider ray ending on a piece
+    - bitboards: 12 piece bitboards as ints in state channel order
+    - planes: 4 per slider type (rook, bishop, queen), in order
+        white defends white, white attacks black, black attacks white, black defends black
+    - indices: list to append to, with offset added to every index
+    """
+    white = 0
+    black = 0
+    for i in range(NUM_PIECES):
+        white |= bitboards[i]
+        black |= bitboards[NUM_PIECES + i]
+    occupied = white | black
+
+    if indices is None:
+        indices = []
+    for idx_slider, (piece, rays) in enumerate(SLIDERS):
+        for color, own in ((0, white), (1, black)):
+            sliders = bitboards[color * NUM_PIECES + piece]
+            while sliders:
+                square = (sliders & -sliders).bit_length() - 1
+                sliders &= sliders - 1
+                for masks, ascending in rays:
+                    blockers = masks[square] & occupied
+                    if not blockers:
+                        continue
+                    if ascending:
+                        target = (blockers & -blockers).bit_length() - 1
+                    else:
+                        target = blockers.bit_length() - 1
+                    defends = (own >> target) & 1
+                    plane = 4 * idx_slider + (1 - defends if color == 0 else 2 + defends)
+                    indices.append(offset + plane * NUM_SQUARES + target)
+    return indices
+
+def featurize_bitboards(bitboards, featurized=True, out=None):
+    """
+    Writes the states of a batch of piece bitboards into one array
+    - bitboards: np.uint64 [N x 12] from bitboards_from_boards
+    - featurized: write all 27 feature planes or only the 12 piece planes
+    - out: array [N x C x 8 x 8] to write into, allocated as float32 if None
+    """
+    bitboards = np.asarray(bitboards, dtype=np.uint64).reshape(-1, NUM_COLORS * NUM_PIECES)
+    num_boards = bitboards.shape[0]
+    num_channels = NUM_FEATURE_CHANNELS if featurized else NUM_COLORS * NUM_PIECES
+    if out is None:
+        out = np.empty((num_boards, num_channels, NUM_ROWS, NUM_COLS), dtype=np.float32)
+
+    idx_layer = NUM_COLORS * NUM_PIECES
+    out[:,:idx_layer] = planes_from_bitboards(bitboards)
+    if not featurized:
+        return out
+
+    # Slider planes, counted for the whole batch at once
+    indices = []
+    num_features = NUM_SLIDER_PLANES * NUM_SQUARES
+    for i, piece_bitboards in enumerate(bitboards.tolist()):
+        slider_attacks(piece_bitboards, indices=indices, offset=i * num_features)
+    attacks = np.bincount(indices, minlength=num_boards * num_features)
+    out[:,idx_layer:idx_layer+NUM_SLIDER_PLANES] = attacks.reshape(num_boards, NUM_SLIDER_PLANES, NUM_ROWS, NUM_COLS)
+    idx_layer += NUM_SLIDER_PLANES
+
+    # White pieces, black pieces, free squares
+    white = np.bitwise_or.reduce(bitboards[:,:NUM_PIECES], axis=1)
+    black = np.bitwise_or.reduce(bitboards[:,NUM_PIECES:], axis=1)
+    out[:,idx_layer:] = planes_from_bitboards(np.stack((white, black, ~(white | black)), axis=1))
+    return out
+
+def featurize_boards(boards, black=False, featurized=True, out=None):
+    """
+    Writes the states of a list of boards into one [N x C x 8 x 8] array
+    - black: bool or per-board list of bools, flipping those boards to black's perspective
+    - out: caller-owned array to reuse across calls, allocated as float32 if None
+    """
+    return featurize_bitboards(bitboards_from_boards(boards, black=black), featurized=featurized, out=out)
 
-    def add_to(arr_dst, arr_src, idx):
-        for i, val in enumerate(idx):
-            if val < 0 or val >= arr_dst.shape[i]:
-                return False
-        try:
-            arr_dst[idx] += arr_src[idx]
-            return arr_src[idx] != 0.0
-        except:
-            return False
-
-    state = state_from_board(board)
-    pieces = board.pawns | board.knights | board.bishops | board.rooks | board.queens | board.kings
-    white_pieces = bitmap_to_array(pieces & board.occupied_co[chess.WHITE])
-    black_pieces = bitmap_to_array(pieces & board.occupied_co[chess.BLACK])
-    free_spaces = bitmap_to_array(~np.uint64(pieces))
-    white_king = bitmap_to_array(board.kings & board.occupied_co[chess.WHITE])
-
-    WHITE, BLACK, OTHER_WHITE, OTHER_BLACK = (0, 1, 2, 3)
-    def apply_mask(mask):
-        non_mask = pieces # & (~mask)
-        white_mask = bitmap_to_array(mask & board.occupied_co[chess.WHITE])
-        black_mask = bitmap_to_array(mask & board.occupied_co[chess.BLACK])
-        white_non_mask = bitmap_to_array(non_mask & board.occupied_co[chess.WHITE])
-        black_non_mask = bitmap_to_array(non_mask & board.occupied_co[chess.BLACK])
-        return white_mask, black_mask, white_non_mask, black_non_mask
-
-    # Knights
-    knights = apply_mask(board.knights)
-    phi_knights = (np.zeros((NUM_ROWS, NUM_COLS)), np.zeros((NUM_ROWS, NUM_COLS)), np.zeros((NUM_ROWS, NUM_COLS)), np.zeros((NUM_ROWS, NUM_COLS)))
-    idx_knight = tuple([[(row,col)] for row in (2,-2) for col in (1,-1)] + \
-                       [[(row,col)] for row in (1,-1) for col in (2,-2)])
-
-    # Rooks
-    rooks = apply_mask(board.rooks)
-    phi_rooks = (np.zeros((NUM_ROWS, NUM_COLS)), np.zeros((NUM_ROWS, NUM_COLS)), np.zeros((NUM_ROWS, NUM_COLS)), np.zeros((NUM_ROWS, NUM_COLS)))
-    idx_rook = ([(row,0) for row in range(1,NUM_ROWS)], \
-                [(0,col) for col in range(1,NUM_COLS)], \
-                [(-row,0) for row in range(1,NUM_ROWS)], \
-                [(0,-col) for col in range(1,NUM_COLS)])
-
-    # Bishops
-    bishops = apply_mask(board.bishops)
-    phi_bishops = (np.zeros((NUM_ROWS, NUM_COLS)), np.zeros((NUM_ROWS, NUM_COLS)), np.zeros((NUM_ROWS, NUM_COLS)), np.zeros((NUM_ROWS, NUM_COLS)))
-    idx_bishop = ([(row,row) for row in range(1,NUM_ROWS)], \
-                  [(-row,row) for row in range(1,NUM_ROWS)], \
-                  [(-row,-row) for row in range(1,NUM_ROWS)], \
-                  [(row,-row) for row in range(1,NUM_ROWS)])
-
-    # Queens
-    queens = apply_mask(board.queens)
-    phi_queens = (np.zeros((NUM_ROWS, NUM_COLS)), np.zeros((NUM_ROWS, NUM_COLS)), np.zeros((NUM_ROWS, NUM_COLS)), np.zeros((NUM_ROWS, NUM_COLS)))
-    idx_queen = idx_rook + idx_bishop
-
-    piece_tuples = [(knights, phi_knights, idx_knight), \
-                    (rooks, phi_rooks, idx_rook), \
-                    (bishops, phi_bishops, idx_bishop), \
-                    (queens, phi_queens, idx_queen)]
-
-    for row in range(NUM_ROWS):
-        for col in range(NUM_COLS):
-            for pieces, phi_pieces, idx_piece in piece_tuples:
-                for direction in idx_piece:
-                    if pieces[WHITE][row,col]:
-                        for idx in direction:
-                            if get(black_pieces, (row+idx[0], col+idx[1])):
-                                break
-                            if add_to(phi_pieces[0], pieces[OTHER_WHITE], (row+idx[0], col+idx[1])):
-                                break
-                        for idx in direction:
-                            if get(white_pieces, (row+idx[0], col+idx[1])):
-                                break
-                            if add_to(phi_pieces[1], pieces[OTHER_BLACK], (row+idx[0], col+idx[1])):
-                                break
-                    if pieces[BLACK][row,col]:
-                        for idx in direction:
-                            if get(black_pieces, (row+idx[0], col+idx[1])):
-                                break
-                            if add_to(phi_pieces[2], pieces[OTHER_WHITE], (row+idx[0], col+idx[1])):
-                                break
-                        for idx in direction:
-                            if get(white_pieces, (row+idx[0], col+idx[1])):
-                                break
-                            if add_to(phi_pieces[3], pieces[OTHER_BLACK], (row+idx[0], col+idx[1])):
-                                break
-
-    # phi = np.array([*phi_knights, *phi_rooks, *phi_bishops, *phi_queens, free_spaces])
-    phi = np.array([*phi_rooks, *phi_bishops, *phi_queens, white_pieces, black_pieces, free_spaces])
-    return np.append(state, phi, axis=0)
+def featurized_state_from_board(board):
+    """
+    Returns the featurized state [27 x 8 rows x 8 cols]
+    - 12 piece planes as in state_from_board
+    - 12 slider planes counting rook, bishop and queen rays that end on a piece
+    - white pieces, black pieces, free squares
+    """
+    return state_from_board(board, featurized=True)
 
 def flip_color_square_idx(from_square, to_square):
     row = NUM_ROWS-1 - (from_square // NUM_ROWS)
@@ -208,64 +266,534 @@ def action_from_move(move, black=False):
     a_to[to_square] = 1
     return (a_from, a_to)
 
+def index_from_move(move, black=False):
+    """
+    Returns the (from * 64 + to) index of the move
+    """
+    from_square = move.from_square
+    to_square = move.to_square
+    if black:
+        from_square, to_square = flip_color_square_idx(from_square, to_square)
+    return from_square * NUM_SQUARES + to_square
+
 def move_from_action(from_square, to_square, black=False):
     if black:
         from_square, to_square = flip_color_square_idx(from_square, to_square)
     return chess.Move(from_square, to_square)
 
+def zobrist_hash(board):
+    """
+    Returns the polyglot Zobrist hash of the board, a Board method in older python-chess
+    """
+    if hasattr(board, "zobrist_hash"):
+        return board.zobrist_hash()
+    return chess.polyglot.zobrist_hash(board)
+
+def legal_move_masks(boards, black=False):
+    """
+    Returns (mask, lookup) of the legal moves of a list of boards
+    - mask: bool [N x 4096] of legal (from * 64 + to) indices as in index_from_move
+    - lookup: per-board {index: move}, where promotions share an index and map to the queen
+    - black: bool or per-board list of bools
+    """
+    black = np.broadcast_to(np.asarray(black, dtype=bool), (len(boards),))
+    mask = np.zeros((len(boards), NUM_SQUARES * NUM_SQUARES), dtype=bool)
+    lookup = []
+    for i, (board, b) in enumerate(zip(boards, black)):
+        moves = {}
+        for move in board.generate_legal_moves():
+            idx = index_from_move(move, black=b)
+            if idx not in moves or move.promotion == chess.QUEEN:
+                moves[idx] = move
+        mask[i, list(moves)] = True
+        lookup.append(moves)
+    return mask, lookup
+
+def bitboards_from_planes(states):
+    """
+    Packs the piece planes of states (..., C, 8, 8) back into np.uint64 bitboards (..., 12)
+    - inverse of planes_from_bitboards, extra feature channels are ignored
+    """
+    planes = np.asarray(states)[..., :NUM_COLORS * NUM_PIECES, :, :] > 0.5
+    # packbits puts the first column in the high bit, so reverse the columns for bit i = column i
+    ranks = np.packbits(planes[..., ::-1], axis=-1)
+    ranks = np.ascontiguousarray(ranks.reshape(ranks.shape[:-2] + (NUM_SQUARES // 8,)))
+    return ranks.view("<u8").reshape(ranks.shape[:-1]).astype(np.uint64)
+
+ALL_CASTLING = chess.BB_A1 | chess.BB_H1 | chess.BB_A8 | chess.BB_H8
+
+def boards_from_bitboards(bitboards, turn=chess.WHITE, castling=None, ep_square=None):
+    """
+    Returns a list of boards set directly from piece bitboards [N x 12]
+    - turn: side to move, bool or per-board array
+    - castling: per-board K Q k q bits as in POSITION_DTYPE, None for all
+                rights the pieces allow (the old "KQkq" FEN default)
+    - ep_square: per-board en passant squares, NO_EP_SQUARE for none
+    """
+    bitboards = np.asarray(bitboards, dtype=np.uint64).reshape(-1, NUM_COLORS * NUM_PIECES)
+    num_boards = len(bitboards)
+    turn = np.broadcast_to(np.asarray(turn, dtype=bool), (num_boards,)).tolist()
+    if castling is None:
+        castling_rights = [ALL_CASTLING] * num_boards
+    else:
+        castling = np.asarray(castling, dtype=np.uint8)
+        masks = np.array([chess.BB_SQUARES[square] for square in CASTLING_SQUARES], dtype=np.uint64)
+        castling_rights = np.bitwise_or.reduce(np.where(BYTE_TO_RANK[castling][:,:4], masks, np.uint64(0)), axis=1).tolist()
+    if ep_square is None:
+        ep_square = [None] * num_boards
+    else:
+        ep_square = [None if square == NO_EP_SQUARE else square for square in np.asarray(ep_square).tolist()]
+
+    boards = []
+    for pieces, t, rights, ep in zip(bitboards.tolist(), turn, castling_rights, ep_square):
+        board = chess.Board(None)
+        white = 0
+        black = 0
+        for i, piece in enumerate(PIECE_BITBOARDS):
+            setattr(board, piece, pieces[i] | pieces[NUM_PIECES + i])
+            white |= pieces[i]
+            black |= pieces[NUM_PIECES + i]
+        board.occupied_co[chess.WHITE] = white
+        board.occupied_co[chess.BLACK] = black
+        board.occupied = white | black
+        board.turn = t
+        board.castling_rights = rights & board.rooks
+        board.ep_square = ep
+        boards.append(board)
+    return boards
+
 def board_from_state(state, black=False):
-    if state.ndim == 4:
-        boards = []
-        for i in range(state.shape[0]):
-            board = board_from_state(np.squeeze(state[i,:,:,:]), black=black)
-            boards.append(board)
-        return boards
-
-    flat_board = np.zeros((NUM_ROWS,NUM_COLS), dtype=int)
-    for i in range(12):
-        flat_board += np.squeeze((i+1)*state[i,:,:].astype(int))
-    pieces = ["","P","N","B","R","Q","K","p","n","b","r","q","k"]
-    fen_str = ""
-    for i in reversed(range(NUM_ROWS)):
-        idx_skip = 0
-        for j in range(NUM_COLS):
-            if flat_board[i,j] == 0:
-                idx_skip += 1
-            else:
-                if idx_skip > 0:
-                    fen_str += str(idx_skip)
-                    idx_skip = 0
-                fen_str += pieces[flat_board[i,j]]
-        if idx_skip > 0:
-            fen_str += str(idx_skip)
-            idx_skip = 0
-        fen_str += "/"
-    fen_str = fen_str[:-1] + " "
-    fen_str += "b" if black else "w"
-    fen_str += " KQkq - 0 1"
-    return chess.Board(fen=fen_str)
+    """
+    Returns the board of a state [C x 8 x 8], or a list of boards of states [N x C x 8 x 8]
+    - black: side to move, the planes carry no turn or castling so all
+             castling rights the pieces allow are kept
+    """
+    boards = boards_from_bitboards(bitboards_from_planes(state), turn=not black)
+    return boards if state.ndim == 4 else boards[0]
+
+# Bit-packed position record for dataset caches (99 bytes)
+# - pieces: 12 piece bitboards, flipped to black's perspective on black plies
+# - turn: side to move (1 white, 0 black)
+# - castling: K Q k q rights as bits 0-3, in the same perspective as pieces
+# - ep_square: en passant square in the same perspective, NO_EP_SQUARE if none
+POSITION_DTYPE = np.dtype([("pieces", "<u8", (NUM_COLORS * NUM_PIECES,)),
+                           ("turn", "u1"),
+                           ("castling", "u1"),
+                           ("ep_square", "u1")])
+NO_EP_SQUARE = 255
+CASTLING_SQUARES = (chess.H1, chess.A1, chess.H8, chess.A8)
+
+def position_from_board(board, black=False):
+    """
+    Returns the POSITION_DTYPE record of the board as a tuple
+    """
+    castling = 0
+    for i, square in enumerate(CASTLING_SQUARES):
+        if board.castling_rights & chess.BB_SQUARES[square]:
+            castling |= 1 << i
+    ep_square = board.ep_square if board.ep_square else NO_EP_SQUARE
+    if black:
+        # Swap KQ with kq and mirror the en passant rank
+        castling = (castling >> 2) | ((castling & 3) << 2)
+        if ep_square != NO_EP_SQUARE:
+            ep_square ^= 56
+    return (bitboards_from_board(board, black=black), int(board.turn), castling, ep_square)
+
+def unpack_positions(positions, featurized=True, out=None):
+    """
+    Expands POSITION_DTYPE records into states [N x C x 8 x 8] as in featurize_bitboards
+    """
+    return featurize_bitboards(positions["pieces"], featurized=featurized, out=out)
+
+def boards_from_positions(positions, black=False):
+    """
+    Returns the boards of POSITION_DTYPE records with their turn, castling and en passant square
+    - black: bool or per-record bools of the records packed from black's
+             perspective, which are flipped back to the real board
+    """
+    black = np.broadcast_to(np.asarray(black, dtype=bool), (len(positions),))
+    pieces = positions["pieces"].astype(np.uint64)
+    castling = positions["castling"].astype(np.uint8)
+    ep_square = positions["ep_square"].astype(np.uint8)
+    if black.any():
+        flipped = pieces[black]
+        pieces[black] = np.roll(flipped, NUM_PIECES, axis=1).byteswap()
+        castling[black] = (castling[black] >> 2) | ((castling[black] & 3) << 2)
+        ep_square[black] = np.where(ep_square[black] == NO_EP_SQUARE, NO_EP_SQUARE, ep_square[black] ^ 56)
+    return boards_from_bitboards(pieces, turn=positions["turn"].astype(bool), castling=castling, ep_square=ep_square)
+
+def pack_actions(a_from, a_to):
+    """
+    Returns uint16 (from * 64 + to) indices of batches of one-hot from/to actions
+    """
+    return (np.argmax(a_from, axis=1) * NUM_SQUARES + np.argmax(a_to, axis=1)).astype(np.uint16)
+
+def sparse_labels(idx):
+    """
+    Returns class indices shaped [N x 1] for sparse_categorical_crossentropy
+    """
+    return idx.astype(np.int32).reshape(-1, 1)
+
+def unpack_actions(states, moves, board="both", sparse=False):
+    """
+    Expands uint16 (from * 64 + to) indices into (X, y) as yielded by state_action_sl
+    - sparse: return integer class indices [N x 1] instead of one-hot labels
+    """
+    moves = moves.astype(np.intp)
+    rows = np.arange(moves.shape[0])
+    if sparse:
+        if board == "full":
+            return states, sparse_labels(moves)
+        elif board == "from":
+            return states, sparse_labels(moves // NUM_SQUARES)
+        elif board == "to":
+            A_from = np.zeros((moves.shape[0], NUM_SQUARES), dtype=np.float32)
+            A_from[rows, moves // NUM_SQUARES] = 1
+            return [states, A_from.reshape(-1,1,NUM_ROWS,NUM_COLS)], sparse_labels(moves % NUM_SQUARES)
+        return states, [sparse_labels(moves // NUM_SQUARES), sparse_labels(moves % NUM_SQUARES)]
+
+    if board == "full":
+        A_combined = np.zeros((moves.shape[0], NUM_SQUARES * NUM_SQUARES), dtype=np.float32)
+        A_combined[rows, moves] = 1
+        return states, A_combined
+
+    A_from = np.zeros((moves.shape[0], NUM_SQUARES), dtype=np.float32)
+    A_to = np.zeros((moves.shape[0], NUM_SQUARES), dtype=np.float32)
+    A_from[rows, moves // NUM_SQUARES] = 1
+    A_to[rows, moves % NUM_SQUARES] = 1
+    if board == "from":
+        return states, A_from
+    elif board == "to":
+        return [states, A_from.reshape(-1,1,NUM_ROWS,NUM_COLS)], A_to
+    return states, [A_from, A_to]
+
+# Labels of one ply for every training head
+# - move: (from * 64 + to) index, flipped with the position
+# - value: game result {-1, 0, 1} from the side to move
+# - reward: value discounted by GAMMA per full move remaining
+# - black: black to move
+PLY_DTYPE = np.dtype([("move", "<u2"),
+                      ("value", "<f4"),
+                      ("reward", "<f4"),
+                      ("black", "?")])
+
+BOARD_TYPES = ("both", "from", "to", "full")
+
+def plies_from_game(game, side=None, flip=True):
+    """
+    Replays a game once and returns the POSITION_DTYPE records and PLY_DTYPE labels of its plies
+    - side: only keep plies of "white" or "black" to move, all plies if None
+    - flip: flip black's plies to white's perspective
+    """
+    board = game.board()
+    z = 0
+    white_score = game.headers["Result"].split("-")[0].split("/")
+    if len(white_score) == 1:
+        z = 2 * int(white_score[0]) - 1
+
+    num_plies = len(game.moves)
+    positions = []
+    plies = []
+    for idx_ply, san in enumerate(game.moves):
+        move = board.parse_san(san)
+        black_turn = idx_ply % 2 == 1
+        if side is None or black_turn == (side == "black"):
+            flip_ply = black_turn and flip
+            value = -z if black_turn else z
+            positions.append(position_from_board(board, black=flip_ply))
+            plies.append((index_from_move(move, black=flip_ply),
+                          value,
+                          GAMMA ** ((num_plies - idx_ply) // 2) * value,
+                          black_turn))
+        board.push(move)
+    return np.array(positions, dtype=POSITION_DTYPE), np.array(plies, dtype=PLY_DTYPE)
+
+def unpack_targets(states, plies, targets=("from", "to"), sparse=False):
+    """
+    Expands PLY_DTYPE labels into (X, y) for the requested heads
+    - targets: a board type as in unpack_actions, or a tuple of heads from
+               "from", "to", "full", "value", "reward", "black"
+    - sparse: return move heads as integer class indices [N x 1]
+    """
+    if targets in BOARD_TYPES:
+        return unpack_actions(states, plies["move"], board=targets, sparse=sparse)
+    moves = plies["move"].astype(np.intp)
+    rows = np.arange(len(plies))
+    y = []
+    for target in targets:
+        if target in ("value", "reward"):
+            y.append(plies[target].astype(np.float32))
+        elif target == "black":
+            y.append(plies["black"].astype(np.float32))
+        else:
+            num_classes = NUM_SQUARES * NUM_SQUARES if target == "full" else NUM_SQUARES
+            idx = moves if target == "full" else (moves // NUM_SQUARES if target == "from" else moves % NUM_SQUARES)
+            if sparse:
+                y.append(sparse_labels(idx))
+                continue
+            A = np.zeros((len(plies), num_classes), dtype=np.float32)
+            A[rows, idx] = 1
+            y.append(A)
+    return states, y[0] if len(y) == 1 else y
+
+class ShuffleBuffer:
+    """
+    Shuffle pool of samples backed by preallocated arrays
+
+    Adding and drawing a batch cost O(batch size) regardless of pool size:
+    samples are copied into free slots, a batch is drawn by fancy indexing
+    random slots, and the holes are filled from the end of the pool.
+    """
+    def __init__(self, pool_size, batch_size):
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self.capacity = pool_size + batch_size
+        self.arrays = None
+        self.size = 0
+        self.num_added = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, *arrays):
+        """
+        Copies a batch of samples (one array per field) into the pool
+        """
+        if self.arrays is None:
+            self.arrays = [np.empty((self.capacity,) + a.shape[1:], dtype=a.dtype) for a in arrays]
+        num_samples = len(arrays[0])
+        for pool, a in zip(self.arrays, arrays):
+            pool[self.size:self.size+num_samples] = a
+        self.size += num_samples
+
+    def pop(self, batch_size):
+        """
+        Removes batch_size random samples from the pool and returns them per field
+        """
+        if 2 * batch_size > self.size:
+            idx = np.random.permutation(self.size)[:batch_size]
+        else:
+            # Rejection sample distinct slots, cheap while the batch is small next to the pool
+            idx = np.unique(np.random.randint(0, self.size, batch_size))
+            while len(idx) < batch_size:
+                idx = np.unique(np.append(idx, np.random.randint(0, self.size, batch_size - len(idx))))
+            np.random.shuffle(idx)
+        batch = [pool[idx] for pool in self.arrays]
+
+        # Move the untaken samples at the end of the pool into the holes
+        idx_tail = self.size - batch_size
+        holes = idx[idx < idx_tail]
+        keep = np.ones(batch_size, dtype=bool)
+        keep[idx[idx >= idx_tail] - idx_tail] = False
+        movers = np.arange(idx_tail, self.size)[keep]
+        if len(holes):
+            for pool in self.arrays:
+                pool[holes] = pool[movers]
+        self.size -= batch_size
+        return batch
+
+    def extend(self, *arrays):
+        """
+        Adds samples and yields a random batch for every batch_size samples added
+        once the pool holds at least pool_size samples
+        """
+        num_samples = len(arrays[0])
+        i = 0
+        while i < num_samples:
+            num_needed = max(self.batch_size - self.num_added, self.pool_size - self.size, 1)
+            num_append = min(num_needed, num_samples - i)
+            self.append(*[a[i:i+num_append] for a in arrays])
+            self.num_added += num_append
+            i += num_append
+
+            if self.num_added >= self.batch_size and self.size >= self.pool_size:
+                self.num_added = 0
+                yield self.pop(self.batch_size)
+
+# Generators that can yield POSITION_DTYPE records for the packed cache
+PACKED_GENERATORS = ("state_action_sl", "white_state_action_sl", "black_state_action_sl", "state_value", "state_targets")
+VALUE_GENERATORS = ("state_value",)
+# Generators whose packed labels are PLY_DTYPE records
+TARGET_GENERATORS = ("state_targets",)
+# Packed caches that can serve a generator besides its own
+PACKED_SUPERSETS = {
+    "state_action_sl": ("state_targets",),
+    "state_value": ("state_targets",)
+}
+# plies_from_game options and min_plies of the games each packed generator replays
+PACKED_PLIES = {
+    "state_action_sl": {},
+    "white_state_action_sl": {"side": "white"},
+    "black_state_action_sl": {"side": "black", "flip": False, "min_plies": 6},
+    "state_value": {},
+    "state_targets": {}
+}
+# Bump whenever the cached records or the generators that fill them change
+CACHE_VERSION = 2
+
+def packed_labels(labels, stored, generator):
+    """
+    Converts packed labels of the stored generator into those of generator
+    """
+    if stored == generator:
+        return labels
+    if generator in VALUE_GENERATORS:
+        return labels["value"]
+    return labels["move"]
+
+# Shards per worker when building the packed cache in parallel, for load balancing
+SHARDS_PER_WORKER = 4
+
+def _pickle_shard(args):
+    filename, games, generator, filename_shard = args
+    return Dataset(filename, games=games).pickle_shard(generator, filename_shard, verbose=False)
+
+def generator_batches(worker, num_workers, filename, generator, kwargs=None):
+    """
+    Prefetcher target yielding a Dataset generator over the worker's share of the games
+    """
+    if num_workers > 1:
+        compressed.require_seekable(filename, "Reading games in several workers")
+    games = np.array_split(Dataset(filename).index()["offset"], num_workers)[worker]
+    return getattr(Dataset(filename, games=games), generator)(**(kwargs or {}))
+
+def read_sts(filename):
+    """
+    Yields (board, id, scores) of the positions of a Strategic Test Suite EPD file
+    - id: the id operation, e.g. "STS(v1.0) Undermining.001"
+    - scores: {move: points} of the moves awarded points by the c0 operation
+    """
+    with compressed.open_input(filename) as epd:
+        for line in epd:
+            if not line.strip():
+                continue
+            board = chess.Board()
+            board.set_epd(line)
+
+            id_test = None
+            scores = {}
+            for token in line.split(";")[1:]:
+                matches = re.match('(id|c0) "(.*)"$', token.strip())
+                if matches is None:
+                    continue
+                if matches.group(1) == "id":
+                    id_test = matches.group(2)
+                    continue
+                # c0 "Nd5=10, Qb3=5, ..."
+                for pair in re.split(",| ", matches.group(2)):
+                    if not pair:
+                        continue
+                    # The score follows the last "=", promotions like e8=Q=10 have another
+                    san, score = pair.strip().rsplit("=", 1)
+                    move = board.parse_san(san)
+                    scores[move] = max(int(score), scores.get(move, 0))
+            yield board, id_test, scores
 
 class Dataset:
-    def __init__(self, filename, loop=False):
+    def __init__(self, filename, loop=False, games=None, cache_bytes=cache.CACHE_BYTES):
+        """
+        - games: byte offsets of the games to restrict the dataset to, all games if None,
+                 or the filename of saved offsets such as a split from split_data.split_index
+        - cache_bytes: byte budget of the cache folder next to the PGN
+        """
         self.filename = filename
         self.loop = loop
+        self.games = np.load(games) if isinstance(games, str) else games
+        self.cache = cache.DatasetCache(os.path.join(os.path.dirname(os.path.abspath(filename)), cache.CACHE_FOLDER),
+                                        max_bytes=cache_bytes)
         self.idx_game = 0
         self.num_games = 0
         # self.idx_moves = []
 
-    def load(self, generator, featurized=True, refresh=False, board="both"):
+    def index(self, min_plies=0):
+        """
+        Returns the game index records of games played through with at least min_plies plies
+        """
+        index = pgn_index.filter_index(pgn_index.load_index(self.filename), min_plies=min_plies)
+        if self.games is not None:
+            # Index offsets are in file order, so matches can be located by binary search
+            offsets = np.intersect1d(index["offset"], np.asarray(self.games, dtype=np.uint64))
+            index = index[np.searchsorted(index["offset"], offsets)]
+        return index
+
+    def read_games(self, pgn, loop=False, min_plies=0, shuffle=False):
+        """
+        Yields games played through with at least min_plies plies as pgn_reader.MainlineGame
+        - seeks straight to each game with the game index, so filtered games are never parsed
+        - shuffle: sample games uniformly at random forever
+        """
+        offsets = self.index(min_plies)["offset"]
+        if shuffle:
+            compressed.require_seekable(self.filename, "Shuffled game reads")
+            while len(offsets):
+                pgn.seek(int(offsets[random.randrange(len(offsets))]))
+                yield pgn_reader.read_mainline(pgn)
+            return
+
+        while True:
+            for offset in offsets:
+                pgn.seek(int(offset))
+                yield pgn_reader.read_mainline(pgn)
+            if not loop:
+                break
+            print("\n******************************************")
+            print("********** LOOPING OVER DATASET **********")
+            print("******************************************\n")
+
+    def load(self, generator, featurized=True, refresh=False, board="both", num_workers=1, sparse=False):
+        """
+        - sparse: return move labels of packed generators as integer class indices
+        """
         assert(type(generator) == str)
 
         if refresh:
-            return self.pickle(generator, featurized=featurized, board=board)
+            return self.pickle(generator, featurized=featurized, board=board, num_workers=num_workers, sparse=sparse)
 
         try:
-            X_y = self.unpickle(generator, featurized=featurized, board=board)
+            X_y = self.unpickle(generator, featurized=featurized, board=board, sparse=sparse)
         except:
-            X_y = self.pickle(generator, featurized=featurized, board=board)
+            X_y = self.pickle(generator, featurized=featurized, board=board, num_workers=num_workers, sparse=sparse)
         return X_y
 
-    def pickle(self, generator, featurized, board):
+    def cache_params(self, generator, featurized=None, board=None):
+        """
+        Returns the parameters that identify a cache build of the generator
+        - packed caches serve every featurized and board setting, so only
+          legacy caches are keyed by them
+        """
+        params = {
+            "generator": generator,
+            "version": CACHE_VERSION,
+            "games": None if self.games is None else \
+                hashlib.sha1(np.asarray(self.games, dtype=np.uint64).tobytes()).hexdigest()
+        }
+        if generator not in PACKED_GENERATORS:
+            params["featurized"] = featurized
+            params["board"] = board
+        return params
+
+    def cache_lookup(self, generator, featurized=None, board=None):
+        """
+        Returns (folder, stored generator) of the cache entry that serves the generator
+        - falls back to a compatible superset, e.g. state_targets for state_value
+        """
+        source = self.cache.source_hash(self.filename)
+        generators = (generator,) + PACKED_SUPERSETS.get(generator, ())
+        candidates = [self.cache_params(g, featurized=featurized, board=board) for g in generators]
+        folder, params = self.cache.lookup(source, candidates)
+        if folder is None:
+            raise IOError("No cache entry for " + generator + " of " + self.filename)
+        return folder, params["generator"]
+
+    def pickle(self, generator, featurized, board, num_workers=1, sparse=False):
+        if generator in PACKED_GENERATORS:
+            self.pickle_packed(generator, num_workers=num_workers)
+            return self.unpickle(generator, featurized=featurized, board=board, sparse=sparse)
+
+        source = self.cache.source_hash(self.filename)
+        params = self.cache_params(generator, featurized=featurized, board=board)
+        filename = os.path.join(self.cache.create(source, params), generator)
+
         X1 = []
         X2 = []
         Y1 = []
@@ -284,32 +812,137 @@ class Dataset:
                 Y1.append(y)
 
         X1 = np.concatenate(X1)
-        np.save(self.filename + "." + generator + "-" + str(featurized) + "-" + board + "-X.npy", X1)
+        np.save(filename + "-X.npy", X1)
 
         if not not X2:
             X2 = np.concatenate(X2)
-            np.save(self.filename + "." + generator + "-" + str(featurized) + "-" + board + "-x2.npy", X2)
+            np.save(filename + "-x2.npy", X2)
 
         Y1 = np.concatenate(Y1)
-        np.save(self.filename + "." + generator + "-" + str(featurized) + "-" + board + "-y.npy", Y1)
+        np.save(filename + "-y.npy", Y1)
+        if Y2:
+            Y2 = np.concatenate(Y2)
+            np.save(filename + "-y2.npy", Y2)
+        self.cache.add(source, params)
+
         if not Y2:
             if type(x) is not list:
                 return X1, Y1
             else:
                 return [X1, X2], Y1
-
-        Y2 = np.concatenate(Y2)
-        np.save(self.filename + "." + generator + "-" + str(featurized) + "-" + board + "-y2.npy", Y2)
         return X1, [Y1, Y2]
 
-    def unpickle(self, generator, featurized, board):
-        X1 = np.load(self.filename + "." + generator + "-" + str(featurized) + "-" + board + "-X.npy")
-        Y1 = np.load(self.filename + "." + generator + "-" + str(featurized) + "-" + board + "-y.npy")
+    def pickle_packed(self, generator, num_workers=1):
+        """
+        Saves positions as POSITION_DTYPE records with uint16 moves, float32 values or PLY_DTYPE labels
+        - the cache serves every featurized and board setting of the generator
+        - num_workers: build shards of the game index in a process pool
+        - writes one positions/labels file pair per shard plus a JSON manifest
+          into a new entry of the dataset cache
+        """
+        source = self.cache.source_hash(self.filename)
+        params = self.cache_params(generator)
+        filename = os.path.join(self.cache.create(source, params), generator + "-packed")
+        print("Pickling packed data:")
+        if num_workers > 1 and not compressed.seekable(self.filename):
+            print("Building serially, " + self.filename + " does not support random access")
+            num_workers = 1
+        if num_workers <= 1:
+            shards = [self.pickle_shard(generator, filename)]
+        else:
+            # Split by game so that every worker seeks straight to its own games
+            offsets = self.index()["offset"]
+            num_shards = max(1, min(len(offsets), num_workers * SHARDS_PER_WORKER))
+            jobs = [(self.filename, games, generator, filename + "-shard%03d" % i) \
+                    for i, games in enumerate(np.array_split(offsets, num_shards))]
+            pool = multiprocessing.Pool(num_workers)
+            try:
+                shards = list(tqdm(pool.imap(_pickle_shard, jobs), total=len(jobs)))
+            finally:
+                pool.close()
+                pool.join()
+
+        manifest = {
+            "generator": generator,
+            "num_positions": sum(shard["num_positions"] for shard in shards),
+            "shards": shards
+        }
+        with open(filename + "-manifest.json", "w") as f:
+            json.dump(manifest, f, indent=2)
+        self.cache.add(source, params)
+        return manifest
+
+    def pickle_shard(self, generator, filename, verbose=True):
+        """
+        Saves the packed positions and labels of the dataset to filename-*.npy
+        - plies are stored in game order straight from plies_from_game, so no
+          position is held back in a shuffle pool, readers shuffle the cache
+        """
+        value = generator in VALUE_GENERATORS
+        targets = generator in TARGET_GENERATORS
+        options = dict(PACKED_PLIES[generator])
+        min_plies = options.pop("min_plies", 5)
+        positions = [np.zeros((0,), dtype=POSITION_DTYPE)]
+        labels = [np.zeros((0,), dtype=PLY_DTYPE if targets else np.float32 if value else np.uint16)]
+        with compressed.open_input(self.filename) as pgn:
+            for game in tqdm(self.read_games(pgn, loop=False, min_plies=min_plies), disable=not verbose):
+                x, plies = plies_from_game(game, **options)
+                positions.append(x)
+                if targets:
+                    labels.append(plies)
+                elif value:
+                    labels.append(plies["value"])
+                else:
+                    labels.append(plies["move"])
+
+        positions = np.concatenate(positions)
+        filename_positions = filename + "-positions.npy"
+        filename_labels = filename + ("-plies.npy" if targets else "-values.npy" if value else "-moves.npy")
+        np.save(filename_positions, positions)
+        np.save(filename_labels, np.concatenate(labels))
+        return {
+            "positions": os.path.basename(filename_positions),
+            "labels": os.path.basename(filename_labels),
+            "num_positions": len(positions)
+        }
+
+    def load_manifest(self, generator):
+        """
+        Returns (folder, manifest) of the packed cache entry that serves the generator
+        """
+        folder, stored = self.cache_lookup(generator)
+        with open(os.path.join(folder, stored + "-packed-manifest.json")) as f:
+            return folder, json.load(f)
+
+    def load_packed(self, generator):
+        """
+        Returns the packed (positions, labels) of all shards as one dataset
+        """
+        folder, manifest = self.load_manifest(generator)
+        shards = manifest["shards"]
+        positions = np.concatenate([np.load(os.path.join(folder, shard["positions"])) for shard in shards])
+        labels = np.concatenate([np.load(os.path.join(folder, shard["labels"])) for shard in shards])
+        return positions, packed_labels(labels, manifest["generator"], generator)
+
+    def unpickle(self, generator, featurized, board, sparse=False):
+        if generator in PACKED_GENERATORS:
+            positions, labels = self.load_packed(generator)
+            S = unpack_positions(positions, featurized=featurized)
+            if generator in TARGET_GENERATORS:
+                return unpack_targets(S, labels, targets=board, sparse=sparse)
+            if generator in VALUE_GENERATORS:
+                return S, labels
+            return unpack_actions(S, labels, board=board, sparse=sparse)
+
+        folder, _ = self.cache_lookup(generator, featurized=featurized, board=board)
+        filename = os.path.join(folder, generator)
+        X1 = np.load(filename + "-X.npy")
+        Y1 = np.load(filename + "-y.npy")
         try:
-            Y2 = np.load(self.filename + "." + generator + "-" + str(featurized) + "-" + board + "-y2.npy")
+            Y2 = np.load(filename + "-y2.npy")
         except:
             try:
-                X2 = np.load(self.filename + "." + generator + "-" + str(featurized) + "-" + board + "-x2.npy")
+                X2 = np.load(filename + "-x2.npy")
             except:
                 return X1, Y1
             return [X1, X2], Y1
@@ -322,39 +955,33 @@ class Dataset:
         return self.sarsa(black=True)
 
     def sarsa(self, black=False):
-        with open(self.filename) as pgn:
-            game = chess.pgn.read_game(pgn)
+        with compressed.open_input(self.filename) as pgn:
+            game = pgn_reader.read_mainline(pgn)
             idx_move = 0
             num_moves = int(game.headers["PlyCount"])
             board = game.board()
-            node = game.root()
             s = state_from_board(board, hashable=True)
             s_prime = s
             while True:
                 if idx_move >= num_moves or num_moves <= 4:
-                    game = chess.pgn.read_game(pgn)
+                    game = pgn_reader.read_mainline(pgn)
                     if game is None:
                         # EOF
                         break
 
                     # Make sure game was played all the way through
-                    last_node = game.root()
-                    while last_node.variations:
-                        last_node = last_node.variations[0]
-                    if "forfeit" in last_node.comment:
+                    if "forfeit" in game.comment:
                         continue
 
                     # Setup game and make sure it has enough moves
                     idx_move = 0
                     num_moves = int(game.headers["PlyCount"])
                     board = game.board()
-                    node = game.root()
                     continue
 
                     if black:
-                        move = node.variations[0].move
+                        move = board.parse_san(game.moves[idx_move])
                         board.push(move)
-                        node = node.variations[0]
                         idx_move += 1
 
                 new_game = (idx_move == 0)
@@ -362,24 +989,22 @@ class Dataset:
                 try:
                     # Play white
                     s = s_prime
-                    move = node.variations[0].move
+                    move = board.parse_san(game.moves[idx_move])
                     board.push(move)
                     a = move.from_square * NUM_SQUARES + move.to_square
                     idx_move += 1
 
                     # Play black
-                    node = node.variations[0]
-                    if node.variations:
-                        move = node.variations[0].move
+                    if idx_move < len(game.moves):
+                        move = board.parse_san(game.moves[idx_move])
                         board.push(move)
-                        node = node.variations[0]
                         idx_move += 1
 
                     s_prime = state_from_board(board, hashable=True)
 
                     a_prime = None
-                    if node.variations:
-                        move = node.variations[0].move
+                    if idx_move < len(game.moves):
+                        move = board.parse_san(game.moves[idx_move])
                         a_prime = move.from_square * NUM_SQUARES + move.to_square
 
                     r = 0
@@ -395,330 +1020,86 @@ class Dataset:
 
                 yield s, a, r, s_prime, a_prime, new_game
 
-    def state_action_sl(self, loop=True, featurized=False, board="both"):
+    def state_targets(self, loop=True, featurized=False, targets=("from", "to"), side=None, flip=True,
+                      packed=False, min_plies=5, pool_size=POOL_SIZE, batch_size=BATCH_SIZE):
+        """
+        Returns (state, targets) batches with every head from one replay of each game
+        - targets: heads to return as in unpack_targets
+        - side: only plies of "white" or "black" to move, all plies if None
+        - flip: flip black's plies to white's perspective
+        - packed: yield POSITION_DTYPE records and PLY_DTYPE labels instead
+        """
+        pool = ShuffleBuffer(pool_size, batch_size)
+        with compressed.open_input(self.filename) as pgn:
+            for game in self.read_games(pgn, loop=loop, min_plies=min_plies):
+                positions, plies = plies_from_game(game, side=side, flip=flip)
+                for positions_batch, plies_batch in pool.extend(positions, plies):
+                    if packed:
+                        yield positions_batch, plies_batch
+                    else:
+                        S = unpack_positions(positions_batch, featurized=featurized)
+                        yield unpack_targets(S, plies_batch, targets=targets)
+
+    def state_action_sl(self, loop=True, featurized=False, board="both", packed=False):
         """
         Returns (state, action) tuple from white's perspective - flips black's perspective to match
         - state: np.array [12 pieces x 64 squares]
             - piece order:  wp wn wb wr wq wk bp bn bb br bq bk
             - square order: a1 b1 c1 ... h8
         - action: [np.array [1 x 64 squares], np.array [1 x 64 squares]] representing [from_board, to_board]
+        - packed: yield POSITION_DTYPE records instead of states
         """
-        from_board = False
-        to_board = False
-        if board == "both":
-            from_board = True
-            to_board = True
-        elif board == "from":
-            from_board = True
-        elif board == "to":
-            to_board = True
-        elif board == "full":
-            pass
-
-        idx_batch = 0
-        with open(self.filename) as pgn:
-            S = []
-            A_from = []
-            A_to = []
-            A_combined = []
-            while True:
-                game = chess.pgn.read_game(pgn)
-                if game is None:
-                    if not loop:
-                        break
-                    print("\n******************************************")
-                    print("********** LOOPING OVER DATASET **********")
-                    print("******************************************\n")
-                    pgn.seek(0)
-                    continue
-
-                num_moves = int(game.headers["PlyCount"])
-                board = game.board()
-                node = game.root()
-
-                if num_moves <= 4:
-                    continue
-
-                # Make sure game was played all the way through
-                last_node = game.root()
-                while last_node.variations:
-                    last_node = last_node.variations[0]
-                if "forfeit" in last_node.comment:
-                    continue
-
-                black_turn = False
-                while node.variations:
-                    # Play white
-                    s = state_from_board(board, featurized=featurized, black=black_turn)
-                    move = node.variations[0].move
-                    a_from, a_to = action_from_move(move, black=black_turn)
-                    board.push(move)
-                    black_turn = not black_turn
-
-                    node = node.variations[0]
-
-                    S.append(s)
-                    A_from.append(a_from)
-                    A_to.append(a_to)
-                    if not (from_board or to_board):
-                        a_combined = np.outer(a_from, a_to).flatten()
-                        A_combined.append(a_combined)
-                    idx_batch += 1
-
-                    if idx_batch >= BATCH_SIZE and len(S) >= POOL_SIZE:
-                        # Shuffle moves in game
-                        idx = list(np.random.permutation(len(S)))
-                        S_shuffle = [S[i] for i in idx]
-                        A_from_shuffle = [A_from[i] for i in idx]
-                        A_to_shuffle = [A_to[i] for i in idx]
-                        S = S_shuffle[BATCH_SIZE:]
-                        A_from = A_from_shuffle[BATCH_SIZE:]
-                        A_to = A_to_shuffle[BATCH_SIZE:]
-                        if not not A_combined:
-                            A_combined_shuffle = [A_combined[i] for i in idx]
-                            A_combined = A_combined_shuffle[BATCH_SIZE:]
-                        idx_batch = 0
-                        if from_board and to_board:
-                            yield (np.array(S_shuffle[:BATCH_SIZE]), \
-                                   [np.array(A_from_shuffle[:BATCH_SIZE]), \
-                                    np.array(A_to_shuffle[:BATCH_SIZE])])
-                        elif from_board:
-                            yield (np.array(S_shuffle[:BATCH_SIZE]), \
-                                   np.array(A_from_shuffle[:BATCH_SIZE]))
-                        elif to_board:
-                            yield ([np.array(S_shuffle[:BATCH_SIZE]), \
-                                    np.array(A_from_shuffle[:BATCH_SIZE]).reshape(BATCH_SIZE,1,NUM_ROWS,NUM_COLS)], \
-                                   np.array(A_to_shuffle[:BATCH_SIZE]))
-                        else:
-                            yield (np.array(S_shuffle[:BATCH_SIZE]), \
-                                   np.array(A_combined_shuffle[:BATCH_SIZE]))
-
+        for positions, plies in self.state_targets(loop=loop, packed=True):
+            S = positions if packed else unpack_positions(positions, featurized=featurized)
+            yield unpack_actions(S, plies["move"], board=board)
 
     def white_phi_action_sl(self, loop=False):
         return self.white_state_action_sl(loop=loop, featurized=True)
 
-    def white_state_action_sl(self, loop=True, featurized=False):
+    def white_state_action_sl(self, loop=True, featurized=False, packed=False):
         """
         Returns (state, action) tuple from white's perspective
         - state: np.array [12 pieces x 64 squares]
             - piece order:  wp wn wb wr wq wk bp bn bb br bq bk
             - square order: a1 b1 c1 ... h8
         - action: [np.array [1 x 64 squares], np.array [1 x 64 squares]] representing [from_board, to_board]
+        - packed: yield POSITION_DTYPE records instead of states
         """
-        BATCH_SIZE = 32
-        idx_batch = 0
-        with open(self.filename) as pgn:
-            S = []
-            A_from = []
-            A_to = []
-            while True:
-                game = chess.pgn.read_game(pgn)
-                if game is None:
-                    if not loop:
-                        break
-                    print("\n******************************************")
-                    print("********** LOOPING OVER DATASET **********")
-                    print("******************************************\n")
-                    pgn.seek(0)
-                    continue
-
-                num_moves = int(game.headers["PlyCount"])
-                board = game.board()
-                node = game.root()
-
-                if num_moves <= 4:
-                    continue
-
-                # Make sure game was played all the way through
-                last_node = game.root()
-                while last_node.variations:
-                    last_node = last_node.variations[0]
-                if "forfeit" in last_node.comment:
-                    continue
-
-                while node.variations:
-                    s = state_from_board(board, featurized=featurized)
-                    move = node.variations[0].move
-                    a_from, a_to = action_from_move(move)
-
-                    # Play white
-                    board.push(move)
-
-                    # Play black
-                    node = node.variations[0]
-                    if node.variations:
-                        move = node.variations[0].move
-                        board.push(move)
-
-                        if node.variations:
-                            node = node.variations[0]
-
-                    S.append(s)
-                    A_from.append(a_from)
-                    A_to.append(a_to)
-                    idx_batch += 1
-
-                    if idx_batch == BATCH_SIZE:
-                        # Shuffle moves in game
-                        idx = list(np.random.permutation(len(S)))
-                        S_shuffle = [S[i] for i in idx]
-                        A_from_shuffle = [A_from[i] for i in idx]
-                        A_to_shuffle = [A_to[i] for i in idx]
-                        S = []
-                        A_from = []
-                        A_to = []
-                        idx_batch = 0
-                        yield np.array(S_shuffle), [np.array(A_from_shuffle), np.array(A_to_shuffle)]
+        for positions, plies in self.state_targets(loop=loop, side="white", pool_size=32, batch_size=32, packed=True):
+            S = positions if packed else unpack_positions(positions, featurized=featurized)
+            yield unpack_actions(S, plies["move"])
 
     def black_phi_action_sl(self, loop=False):
         return self.white_state_action_sl(loop=loop, featurized=True)
 
-    def black_state_action_sl(self, loop=True, featurized=False):
+    def black_state_action_sl(self, loop=True, featurized=False, packed=False):
         """
         Returns (state, action) tuple from black's perspective
         - state: np.array [12 pieces x 64 squares]
             - piece order:  wp wn wb wr wq wk bp bn bb br bq bk
             - square order: a1 b1 c1 ... h8
         - action: [np.array [1 x 64 squares], np.array [1 x 64 squares]] representing [from_board, to_board]
+        - packed: yield POSITION_DTYPE records instead of states
         """
-        BATCH_SIZE = 32
-        idx_batch = 0
-        with open(self.filename) as pgn:
-            S = []
-            A_from = []
-            A_to = []
-            while True:
-                game = chess.pgn.read_game(pgn)
-                if game is None:
-                    if not loop:
-                        break
-                    print("\n******************************************")
-                    print("********** LOOPING OVER DATASET **********")
-                    print("******************************************\n")
-                    pgn.seek(0)
-                    continue
-
-                num_moves = int(game.headers["PlyCount"])
-                board = game.board()
-                node = game.root()
-
-                if num_moves <= 5:
-                    continue
-
-                # Make sure game was played all the way through
-                last_node = game.root()
-                while last_node.variations:
-                    last_node = last_node.variations[0]
-                if "forfeit" in last_node.comment:
-                    continue
-
-                # Play white
-                move = node.variations[0].move
-                board.push(move)
-                node = node.variations[0]
-
-                while node.variations:
-                    s = state_from_board(board, featurized=featurized)
-                    move = node.variations[0].move
-                    a_from, a_to = action_from_move(move)
-
-                    # Play black
-                    board.push(move)
-
-                    # Play white
-                    node = node.variations[0]
-                    if node.variations:
-                        move = node.variations[0].move
-                        board.push(move)
+        for positions, plies in self.state_targets(loop=loop, side="black", flip=False, min_plies=6,
+                                                   pool_size=32, batch_size=32, packed=True):
+            S = positions if packed else unpack_positions(positions, featurized=featurized)
+            yield unpack_actions(S, plies["move"])
 
-                        if node.variations:
-                            node = node.variations[0]
-
-                    S.append(s)
-                    A_from.append(a_from)
-                    A_to.append(a_to)
-                    idx_batch += 1
-
-                    if idx_batch == BATCH_SIZE:
-                        # Shuffle moves in game
-                        idx = list(np.random.permutation(len(S)))
-                        S_shuffle = [S[i] for i in idx]
-                        A_from_shuffle = [A_from[i] for i in idx]
-                        A_to_shuffle = [A_to[i] for i in idx]
-                        S = []
-                        A_from = []
-                        A_to = []
-                        idx_batch = 0
-                        yield np.array(S_shuffle), [np.array(A_from_shuffle), np.array(A_to_shuffle)]
-
-    def state_value(self, loop=True, featurized=False, board='both'):
+    def state_value(self, loop=True, featurized=False, board='both', packed=False):
         """
         Returns (state, action) tuple from white's perspective - flips black's perspective to match
         - state: np.array [12 pieces x 64 squares]
             - piece order:  wp wn wb wr wq wk bp bn bb br bq bk
             - square order: a1 b1 c1 ... h8
         - action: [np.array [1 x 64 squares], np.array [1 x 64 squares]] representing [from_board, to_board]
+        - packed: yield POSITION_DTYPE records instead of states
         """
-        idx_batch = 0
-        with open(self.filename) as pgn:
-            S = []
-            R = []
-            while True:
-                game = chess.pgn.read_game(pgn)
-                if game is None:
-                    if not loop:
-                        break
-                    print("\n******************************************")
-                    print("********** LOOPING OVER DATASET **********")
-                    print("******************************************\n")
-                    pgn.seek(0)
-                    continue
-
-                num_moves = int(game.headers["PlyCount"])
-                board = game.board()
-                node = game.root()
-
-                if num_moves <= 4:
-                    continue
-
-                # Make sure game was played all the way through
-                last_node = game.root()
-                while last_node.variations:
-                    last_node = last_node.variations[0]
-                if "forfeit" in last_node.comment:
-                    continue
-
-                z = 0
-                white_score = game.headers["Result"].split("-")[0].split("/")
-                if len(white_score) == 1:
-                    z = 2 * int(white_score[0]) - 1
-
-                black_turn = False
-                while node.variations:
-                    # Play white
-                    s = state_from_board(board, featurized=featurized, black=black_turn)
-                    move = node.variations[0].move
-                    r = z if not black_turn else -z
-                    board.push(move)
-                    black_turn = not black_turn
-
-                    node = node.variations[0]
-
-                    S.append(s)
-                    R.append(r)
-                    idx_batch += 1
+        for positions, plies in self.state_targets(loop=loop, packed=True):
+            S = positions if packed else unpack_positions(positions, featurized=featurized)
+            yield S, plies["value"]
 
-                    if idx_batch >= BATCH_SIZE and len(S) >= POOL_SIZE:
-                        # Shuffle moves in game
-                        idx = list(np.random.permutation(len(S)))
-                        S_shuffle = [S[i] for i in idx]
-                        R_shuffle = [R[i] for i in idx]
-                        S = S_shuffle[BATCH_SIZE:]
-                        R = R_shuffle[BATCH_SIZE:]
-                        idx_batch = 0
-                        yield np.array(S_shuffle[:BATCH_SIZE]), np.array(R_shuffle[:BATCH_SIZE])
-
-    def random_white_state(self):
+    def random_white_state(self, shuffle=False):
         """
         Returns (state, action, reward) tuple from white's perspective
         - state: np.array [12 pieces x 64 squares]
@@ -728,23 +1109,11 @@ class Dataset:
             - action_array[ind2sub(action)]: move piece at square j to square k and promote to piece type i
             - promotion piece order: None p n b r q k
         - result: {-1, 0, 1} (lose, draw, win)
+        - shuffle: sample games uniformly at random forever instead of in file order
         """
-        with open(self.filename) as pgn:
-            while True:
-                game = chess.pgn.read_game(pgn)
-                if game is None:
-                    break
-
+        with compressed.open_input(self.filename) as pgn:
+            for game in self.read_games(pgn, min_plies=2, shuffle=shuffle):
                 num_moves = int(game.headers["PlyCount"])
-                if num_moves < 2:
-                    continue
-
-                # Make sure game was played all the way through
-                last_node = game.root()
-                while last_node.variations:
-                    last_node = last_node.variations[0]
-                if "forfeit" in last_node.comment:
-                    continue
 
                 # Choose a random white-turn state
                 idx_move = random.randint(1, num_moves // 2) * 2
@@ -752,12 +1121,10 @@ class Dataset:
 
                 # Play moves up to idx_move
                 board = game.board()
-                node = game.root()
-                for i in range(idx_move):
-                    board.push(node.variations[0].move)
-                    node = node.variations[0]
+                for san in game.moves[:idx_move]:
+                    board.push(board.parse_san(san))
 
-                move = node.variations[0].move
+                move = board.parse_san(game.moves[idx_move])
                 promotion = move.promotion
                 if promotion is None:
                     promotion = 0
@@ -776,7 +1143,7 @@ class Dataset:
 
                 yield state, action, result
 
-    def random_black_state(self):
+    def random_black_state(self, shuffle=False):
         """
         Returns (state, reward) tuple at black's turn from white's perspective
         - state: np.array [12 pieces x 8 rows x 8 cols]
@@ -784,62 +1151,49 @@ class Dataset:
             - row order: a b c ... h
             - col order: 1 2 3 ... 8
         - reward: GAMMA^moves_remaining * {-1, 0, 1} (lose, draw, win)
+        - shuffle: sample games uniformly at random forever instead of in file order
         """
-        with open(self.filename) as pgn:
+        with compressed.open_input(self.filename) as pgn:
             while True:
-                game = chess.pgn.read_game(pgn)
-                if game is None:
-                    if not self.loop:
-                        break
-                    pgn.seek(0)
-                    self.num_games = self.idx_game
-                    self.idx_game = 0
-                    continue
-
-                num_moves = int(game.headers["PlyCount"])
-                if num_moves < 2:
-                    continue
+                for game in self.read_games(pgn, min_plies=2, shuffle=shuffle):
+                    num_moves = int(game.headers["PlyCount"])
 
-                # Make sure game was played all the way through
-                last_node = game.root()
-                while last_node.variations:
-                    last_node = last_node.variations[0]
-                if "forfeit" in last_node.comment:
-                    continue
+                    # Choose a random black-turn state
+                    # if self.test_set:
+                    #     if self.num_games:
+                    #         idx_move = self.idx_moves[self.idx_game]
+                    #     else:
+                    #         idx_move = random.randint(1, num_moves // 2) * 2 - 1
+                    #         self.idx_moves.append(idx_move)
+                    # else:
+                    #     idx_move = random.randint(1, num_moves // 2) * 2 - 1
+                    idx_move = random.randint(1, num_moves // 2) * 2 - 1
+                    moves_remaining = (num_moves - idx_move) // 2
+
+                    # Play moves up to idx_move
+                    board = game.board()
+                    for san in game.moves[:idx_move]:
+                        board.push(board.parse_san(san))
 
-                # Choose a random black-turn state
-                # if self.test_set:
-                #     if self.num_games:
-                #         idx_move = self.idx_moves[self.idx_game]
-                #     else:
-                #         idx_move = random.randint(1, num_moves // 2) * 2 - 1
-                #         self.idx_moves.append(idx_move)
-                # else:
-                #     idx_move = random.randint(1, num_moves // 2) * 2 - 1
-                idx_move = random.randint(1, num_moves // 2) * 2 - 1
-                moves_remaining = (num_moves - idx_move) // 2
+                    # headers["Result"]: {"0-1", "1-0", "1/2-1/2"}
+                    # result: {-1, 0, 1}
+                    # Parse result from header
+                    white_score = game.headers["Result"].split("-")[0].split("/")
+                    if len(white_score) == 1:
+                        result = 2 * int(white_score[0]) - 1
+                    else:
+                        result = 0
 
-                # Play moves up to idx_move
-                board = game.board()
-                node = game.root()
-                for i in range(idx_move):
-                    board.push(node.variations[0].move)
-                    node = node.variations[0]
+                    state = state_from_board(board).reshape((1, NUM_COLORS * NUM_PIECES, NUM_ROWS, NUM_COLS))
+                    reward = np.array([(GAMMA ** moves_remaining) * result])
 
-                # headers["Result"]: {"0-1", "1-0", "1/2-1/2"}
-                # result: {-1, 0, 1}
-                # Parse result from header
-                white_score = game.headers["Result"].split("-")[0].split("/")
-                if len(white_score) == 1:
-                    result = 2 * int(white_score[0]) - 1
-                else:
-                    result = 0
-
-                state = state_from_board(board).reshape((1, NUM_COLORS * NUM_PIECES, NUM_ROWS, NUM_COLS))
-                reward = np.array([(GAMMA ** moves_remaining) * result])
+                    self.idx_game += 1
+                    yield state, reward
 
-                self.idx_game += 1
-                yield state, reward
+                if not self.loop:
+                    break
+                self.num_games = self.idx_game
+                self.idx_game = 0
 
     def load_sts(self, featurized=False, board_type="both"):
         """
@@ -850,57 +1204,18 @@ class Dataset:
         - action: np.array [6 pieces x 1] representing piece type
             - piece type: p n b r q k
         """
-        with open(self.filename) as epd:
-            list_scores = []
-            S = []
-            A_from = []
-            A_to = []
-            for line in epd:
-                # Setup board
-                board = chess.Board()
-                board.set_epd(line)
-
-                # Parse test id
-                tokens = line.split(";")
-                matches = re.match('id "(.*)"$', tokens[1].strip())
-                if matches is not None:
-                    id_test = matches.group(1)
-
-                # Parse possible moves and keep track of best one
-                scores = {}
-                max_score = 0
-                max_move = None
-                matches = re.match('c0 "(.*)"$', tokens[2].strip())
-                if matches is not None:
-                    tokens = re.split(",| ", matches.group(1))
-                    tokens = [token for token in tokens if token]
-                    for token in tokens:
-                        pair = token.strip().split("=")
-                        move = board.parse_san(pair[0])
-                        uci = board.uci(move)
-                        score = int(pair[1])
-                        scores[uci] = score
-                        if score > max_score:
-                            max_score = score
-                            max_move = move
-
-                # Convert to state and action representation
-                s = state_from_board(board, featurized=featurized, black=False)
-                a_from, a_to = action_from_move(max_move, black=False)
-
-                list_scores.append(scores)
-                S.append(s)
-                A_from.append(a_from)
-                A_to.append(a_to)
-
-            S = np.array(S)
-            A_from = np.array(A_from)
-            A_to = np.array(A_to)
-            if board_type == "both":
-                return S, [A_from, A_to]
-            elif board_type == "from":
-                return S, A_from
-            elif board_type == "to":
-                return [S, A_from.reshape(-1,1,NUM_ROWS,NUM_COLS)], A_to
-            else:
-                return list_scores
+        list_scores = []
+        boards = []
+        moves = []
+        for board, _, scores in read_sts(self.filename):
+            # Keep track of the best move
+            max_move = max(scores, key=lambda move: scores[move]) if scores else None
+            list_scores.append({board.uci(move): score for move, score in scores.items()})
+            boards.append(board)
+            moves.append(index_from_move(max_move))
+
+        if board_type in ("both", "from", "to"):
+            S = featurize_boards(boards, featurized=featurized)
+            return unpack_actions(S, np.array(moves, dtype=np.uint16), board=board_type)
+        else:
+            return list_scores
@@ -0,0 +1,165 @@
+import os
+import numpy as np
+import data
+from reader import open_packed
+from tqdm import tqdm
+
+# One record per unique position, keyed by the Zobrist hash of the packed
+# record; positions are already flipped to the side to move as in flip_state
+# - count: number of occurrences in the corpus
+# - value: mean result from the side to move
+# - move_offset: first row of the position in the moves array
+DEDUP_DTYPE = np.dtype([("position", data.POSITION_DTYPE),
+                        ("hash", "<u8"),
+                        ("count", "<u4"),
+                        ("value", "<f4"),
+                        ("move_offset", "<u8")])
+
+# Moves played from each unique position, grouped by position
+MOVE_COUNT_DTYPE = np.dtype([("move", "<u2"),
+                             ("count", "<u4")])
+
+CHUNK_SIZE = 8192
+
+_keys = np.random.RandomState(2017).randint(1, 2**62, size=(data.NUM_COLORS * data.NUM_PIECES * data.NUM_SQUARES + 4 + data.NUM_SQUARES + 1)).astype(np.uint64)
+PIECE_KEYS = _keys[:data.NUM_COLORS * data.NUM_PIECES * data.NUM_SQUARES]
+CASTLING_KEYS = _keys[len(PIECE_KEYS):len(PIECE_KEYS)+4]
+EP_KEYS = _keys[len(PIECE_KEYS)+4:]
+
+def zobrist_hashes(positions):
+    """
+    Returns the uint64 Zobrist hashes of POSITION_DTYPE records
+    """
+    hashes = np.empty(len(positions), dtype=np.uint64)
+    for i in range(0, len(positions), CHUNK_SIZE):
+        chunk = positions[i:i+CHUNK_SIZE]
+        planes = data.planes_from_bitboards(chunk["pieces"]).reshape(len(chunk), -1)
+        h = np.bitwise_xor.reduce(np.where(planes, PIECE_KEYS, np.uint64(0)), axis=1)
+        castling = data.BYTE_TO_RANK[chunk["castling"]][:,:4]
+        h ^= np.bitwise_xor.reduce(np.where(castling, CASTLING_KEYS, np.uint64(0)), axis=1)
+        h ^= EP_KEYS[np.minimum(chunk["ep_square"], data.NUM_SQUARES)]
+        hashes[i:i+CHUNK_SIZE] = h
+    return hashes
+
+def build_dedup(dataset, refresh=False, num_workers=1):
+    """
+    Compacts the state_targets cache of the dataset into one record per
+    unique position with aggregated move counts and mean value, saved as an
+    entry of the dataset cache
+    """
+    reader = open_packed(dataset, "state_targets", refresh=refresh, num_workers=num_workers)
+
+    print("Deduplicating positions:")
+    hashes = []
+    for i in tqdm(range(0, len(reader), CHUNK_SIZE)):
+        positions, _ = reader.read(np.arange(i, min(i + CHUNK_SIZE, len(reader))))
+        hashes.append(zobrist_hashes(positions))
+    hashes = np.concatenate(hashes) if hashes else np.zeros((0,), dtype=np.uint64)
+    unique_hashes, idx_first, inverse, counts = np.unique(hashes, return_index=True, return_inverse=True, return_counts=True)
+    positions, _ = reader.read(idx_first)
+    _, plies = reader.read(np.arange(len(reader)))
+
+    # Count every (position, move) pair, sorted by position then move
+    num_moves = data.NUM_SQUARES * data.NUM_SQUARES
+    pairs, pair_counts = np.unique(inverse.astype(np.uint64) * num_moves + plies["move"], return_counts=True)
+    move_counts = np.empty(len(pairs), dtype=MOVE_COUNT_DTYPE)
+    move_counts["move"] = pairs % num_moves
+    move_counts["count"] = pair_counts
+
+    records = np.empty(len(unique_hashes), dtype=DEDUP_DTYPE)
+    records["position"] = positions
+    records["hash"] = unique_hashes
+    records["count"] = counts
+    records["value"] = np.bincount(inverse, weights=plies["value"], minlength=len(unique_hashes)) / np.maximum(counts, 1)
+    records["move_offset"] = np.searchsorted(pairs // num_moves, np.arange(len(unique_hashes)))
+
+    source = dataset.cache.source_hash(dataset.filename)
+    params = dataset.cache_params("dedup")
+    folder = dataset.cache.create(source, params)
+    np.save(os.path.join(folder, "dedup-positions.npy"), records)
+    np.save(os.path.join(folder, "dedup-moves.npy"), move_counts)
+    dataset.cache.add(source, params)
+    print("%d positions, %d unique" % (len(hashes), len(unique_hashes)))
+    return folder
+
+class DedupReader:
+    """
+    Memory-mapped reader over the deduplicated positions of a dataset
+
+    Each unique position is featurized once per draw and labelled with the
+    distribution of moves played from it instead of a single move.
+    - alpha: sample positions with probability proportional to count ** alpha,
+             1 matches the occurrence frequency of the original corpus
+    """
+    def __init__(self, folder, alpha=1.0):
+        self.records = np.load(os.path.join(folder, "dedup-positions.npy"), mmap_mode="r")
+        self.moves = np.load(os.path.join(folder, "dedup-moves.npy"), mmap_mode="r")
+        self.move_ends = np.append(self.records["move_offset"][1:], len(self.moves)).astype(np.intp)
+        weights = self.records["count"].astype(np.float64) ** alpha
+        self.cdf = np.cumsum(weights) / weights.sum()
+
+    def __len__(self):
+        return len(self.records)
+
+    def batch(self, indices, featurized=True, board="both", value=False):
+        """
+        Returns (X, y) for the given unique positions as yielded by the generators,
+        with move targets normalised into distributions
+        """
+        indices = np.asarray(indices)
+        records = self.records[indices]
+        S = data.unpack_positions(records["position"], featurized=featurized)
+        if value:
+            return S, records["value"].astype(np.float32)
+
+        # Gather the move rows of every position in the batch
+        starts = records["move_offset"].astype(np.intp)
+        lengths = self.move_ends[indices] - starts
+        rows = np.repeat(np.arange(len(indices)), lengths)
+        idx_moves = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        moves = self.moves[idx_moves]["move"].astype(np.intp)
+        weights = self.moves[idx_moves]["count"] / records["count"][rows].astype(np.float32)
+
+        if board == "full":
+            A_combined = np.zeros((len(indices), data.NUM_SQUARES * data.NUM_SQUARES), dtype=np.float32)
+            np.add.at(A_combined, (rows, moves), weights)
+            return S, A_combined
+
+        A_from = np.zeros((len(indices), data.NUM_SQUARES), dtype=np.float32)
+        A_to = np.zeros((len(indices), data.NUM_SQUARES), dtype=np.float32)
+        np.add.at(A_from, (rows, moves // data.NUM_SQUARES), weights)
+        np.add.at(A_to, (rows, moves % data.NUM_SQUARES), weights)
+        if board == "from":
+            return S, A_from
+        elif board == "to":
+            return [S, A_from.reshape(-1,1,data.NUM_ROWS,data.NUM_COLS)], A_to
+        return S, [A_from, A_to]
+
+    def generator(self, batch_size=32, featurized=True, board="both", value=False):
+        """
+        Yields (X, y) batches of positions sampled by their weights forever
+        """
+        while True:
+            indices = np.searchsorted(self.cdf, np.random.random_sample(batch_size), side="right")
+            indices = np.minimum(indices, len(self) - 1)
+            yield self.batch(np.sort(indices), featurized=featurized, board=board, value=value)
+
+def open_dedup(dataset, refresh=False, num_workers=1, alpha=1.0):
+    """
+    Returns a DedupReader for the dataset, building its deduplicated store if missing
+    """
+    folder = None
+    if not refresh:
+        source = dataset.cache.source_hash(dataset.filename)
+        folder, _ = dataset.cache.lookup(source, [dataset.cache_params("dedup")])
+    if folder is None:
+        folder = build_dedup(dataset, refresh=refresh, num_workers=num_workers)
+    return DedupReader(folder, alpha=alpha)
+
+def dedup_batches(worker, num_workers, filename, batch_size=32, featurized=True, board="both", value=False, alpha=1.0, games=None):
+    """
+    Prefetcher target yielding batches of an existing dedup store, opened in the worker
+    - games: game offsets or offsets filename of the dataset as in Dataset
+    """
+    return open_dedup(data.Dataset(filename, games=games), alpha=alpha).generator(batch_size, featurized=featurized,
+                                                                     board=board, value=value)
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+from keras.models import load_model
+import numpy as np
+import sys
+import time
+sys.path.append('.')
+from engines.ChessEngine import ChessEngine
+import chess
+import data
+import eval_table
+
+MATE_VALUE = 2.  # beyond the tanh range of the value network
+MATE_THRESHOLD = 1.5
+VALUE_TO_CP = 1000  # centipawns reported per unit of value
+MAX_DEPTH = 64
+DEFAULT_DEPTH = 4  # when go has no time, depth or node limit
+QUIESCENCE_DEPTH = 4
+PRIOR_DEPTH = 2  # policy priors order nodes with at least this depth left, captures first below
+TT_SIZE = 2**20  # entries, a power of two
+CHECK_EVERY = 32  # nodes between time and node limit checks
+TIME_FRACTION = 0.5  # skip the next iteration once this fraction of the budget is used
+
+# Transposition table bounds
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+# Victim and attacker values by piece type for MVV-LVA capture ordering
+PIECE_VALUES = (0, 1, 3, 3, 5, 9, 0)
+
+class SearchStopped(Exception):
+    pass
+
+def _encode_move(move):
+    if move is None:
+        return 0
+    return (move.promotion or 0) << 12 | move.from_square << 6 | move.to_square
+
+def _decode_move(code):
+    if code == 0:
+        return None
+    return chess.Move(code >> 6 & 63, code & 63, code >> 12 or None)
+
+class TranspositionTable:
+    """
+    Fixed-size transposition table of (depth, value, flag, move) by Zobrist hash
+
+    Entries live in preallocated arrays indexed by the low bits of the key,
+    so the memory use is fixed up front. A new entry replaces one of another
+    key only if that one is from an earlier search or searched no deeper.
+    """
+    def __init__(self, size=TT_SIZE):
+        self.mask = size - 1
+        self.keys = np.zeros(size, dtype=np.uint64)
+        self.values = np.zeros(size, dtype=np.float32)
+        self.moves = np.zeros(size, dtype=np.uint16)
+        self.depths = np.zeros(size, dtype=np.int8)
+        self.flags = np.zeros(size, dtype=np.uint8)
+        self.generations = np.zeros(size, dtype=np.uint8)  # 0 for empty entries
+        self.generation = 1
+
+    def new_search(self):
+        self.generation = self.generation % 255 + 1
+
+    def get(self, key):
+        idx = key & self.mask
+        if self.generations[idx] == 0 or self.keys[idx] != key:
+            return None
+        return int(self.depths[idx]), float(self.values[idx]), int(self.flags[idx]), \
+               _decode_move(int(self.moves[idx]))
+
+    def put(self, key, depth, value, flag, move):
+        idx = key & self.mask
+        if self.generations[idx] == self.generation and self.keys[idx] != key and self.depths[idx] > depth:
+            return
+        self.keys[idx] = key
+        self.values[idx] = value
+        self.moves[idx] = _encode_move(move)
+        self.depths[idx] = depth
+        self.flags[idx] = flag
+        self.generations[idx] = self.generation
+
+    def hashfull(self):
+        """
+        Returns the permille of used entries as reported by UCI info hashfull
+        """
+        return int(1000 * np.count_nonzero(self.generations) // self.generations.size)
+
+    def clear(self):
+        self.generations[:] = 0
+
+class AlphaBetaEngine(ChessEngine):
+    """
+    Iterative deepening alpha-beta over the value network
+
+    - value: negamax scores in value units from the side to move, evaluated
+             by the value network with positions flipped to the side to move
+    - leaves: the children of every depth 1 node and the captures of every
+              quiescence node are evaluated in one batched predict, and
+              network outputs are kept in an eval_table.EvalTable
+    - ordering: transposition table move first, then the joint from x to
+                probability of the policy network at nodes PRIOR_DEPTH or
+                more from the frontier, captures by MVV-LVA elsewhere; the
+                priors of all children of a node are predicted in one batch
+    - draws: repetitions of the game or the search path, the fifty-move rule
+             and insufficient material score 0
+    - mates: stored in the transposition table as distances from the node
+    - limits: depth, nodes, movetime, wtime/btime with winc/binc/movestogo,
+              infinite until stop
+    """
+    def __init__(self, value_hdf5, policy_hdf5=None, featurized=True, table=None):
+        """
+        - policy_hdf5: from/to policy model for move ordering, MVV-LVA only if None
+        - table: eval_table.EvalTable of values and policies from the side to
+                 move, shared by engines of the same networks if None
+        """
+        super().__init__()
+        self.engine_name = "Alpha-Beta Value Engine"
+        self.value_model = load_model(value_hdf5)
+        self.policy_model = load_model(policy_hdf5) if policy_hdf5 is not None else None
+        self.featurized = featurized
+        self.tt = TranspositionTable()
+        # Zobrist hash -> occurrences in the game and the current search path
+        self.repetitions = {}
+        self.table = table if table is not None else \
+            eval_table.shared_table((value_hdf5, policy_hdf5, featurized))
+        self.moves = None
+
+    def ucinewgame(self):
+        super().ucinewgame()
+        self.tt.clear()
+
+    ##############
+    # Evaluation #
+    ##############
+    def evaluate_children(self, moves):
+        """
+        Evaluates the uncached children of the current board in one batched predict
+        """
+        keys = []
+        bitboards = []
+        for move in moves:
+            self.board.push(move)
+            keys.append(data.zobrist_hash(self.board))
+            bitboards.append(data.bitboards_from_board(self.board, black=self.board.turn == chess.BLACK))
+            self.board.pop()
+        hits, _ = self.table.probe_values(keys)
+        idx_missing = np.flatnonzero(~hits)
+        if len(idx_missing):
+            self.predict_values(np.array(keys, dtype=np.uint64)[idx_missing], np.array(bitboards)[idx_missing])
+
+    def predict_values(self, keys, bitboards):
+        """
+        Returns the values of the bitboards [N x 12] from one predict, stored in the table under keys
+        """
+        X = data.featurize_bitboards(bitboards, featurized=self.featurized)
+        values = self.value_model.predict(X, batch_size=len(keys), verbose=0).flatten()
+        self.table.store(keys, values=values)
+        self.num_evals += len(keys)
+        self.num_batches += 1
+        return values
+
+    def evaluate(self, key):
+        """
+        Returns the value of the current board from the side to move
+        """
+        hits, values = self.table.probe_values([key])
+        if hits[0]:
+            return float(values[0])
+        bitboards = data.bitboards_from_board(self.board, black=self.board.turn == chess.BLACK)
+        return float(self.predict_values([key], bitboards[None])[0])
+
+    #################
+    # Move ordering #
+    #################
+    def policy_priors(self, key):
+        """
+        Returns the joint from x to probabilities [4096] of the current board from the side to move
+        """
+        hits, policies = self.table.probe_policies([key])
+        if hits[0]:
+            y_from, y_to = policies[:,:data.NUM_SQUARES], policies[:,data.NUM_SQUARES:]
+        else:
+            X = data.featurize_boards([self.board], black=self.board.turn == chess.BLACK, featurized=self.featurized)
+            y_from, y_to = self.policy_model.predict(X, batch_size=1, verbose=0)
+            self.table.store([key], policies=np.concatenate([y_from, y_to], axis=1))
+        return np.outer(y_from[0], y_to[0]).ravel()
+
+    def predict_priors(self, moves):
+        """
+        Predicts the policies of the children of the current board missing from the table in one batch
+        """
+        keys = []
+        bitboards = []
+        for move in moves:
+            self.board.push(move)
+            keys.append(data.zobrist_hash(self.board))
+            bitboards.append(data.bitboards_from_board(self.board, black=self.board.turn == chess.BLACK))
+            self.board.pop()
+        hits, _ = self.table.probe_policies(keys)
+        idx_missing = np.flatnonzero(~hits)
+        if not len(idx_missing):
+            return
+        X = data.featurize_bitboards(np.array(bitboards)[idx_missing], featurized=self.featurized)
+        y_from, y_to = self.policy_model.predict(X, batch_size=len(X), verbose=0)
+        self.table.store(np.array(keys, dtype=np.uint64)[idx_missing], policies=np.concatenate([y_from, y_to], axis=1))
+
+    def order_moves(self, moves, key, depth, tt_move=None):
+        board = self.board
+        if self.policy_model is not None and depth >= PRIOR_DEPTH:
+            priors = self.policy_priors(key)
+            black = board.turn == chess.BLACK
+            moves = sorted(moves, key=lambda move: -priors[data.index_from_move(move, black=black)])
+        else:
+            def mvv_lva(move):
+                if not board.is_capture(move):
+                    return 0 if move.promotion is None else -PIECE_VALUES[move.promotion]
+                victim = board.piece_at(move.to_square)
+                victim = chess.PAWN if victim is None else victim.piece_type  # en passant
+                return -10 * PIECE_VALUES[victim] + PIECE_VALUES[board.piece_at(move.from_square).piece_type]
+            moves = sorted(moves, key=mvv_lva)
+        if tt_move is not None and tt_move in moves:
+            moves.remove(tt_move)
+            moves.insert(0, tt_move)
+        return moves
+
+    ##########
+    # Search #
+    ##########
+    def check_limits(self):
+        if self.stop_event.is_set() \
+           or (self.max_nodes is not None and self.nodes >= self.max_nodes) \
+           or (self.deadline is not None and time.time() >= self.deadline):
+            raise SearchStopped()
+
+    def is_draw(self, key):
+        """
+        Returns whether the current board is drawn by the fifty-move rule, insufficient
+        material or a repetition of a position of the game or the search path
+        """
+        return self.board.halfmove_clock >= 100 or self.repetitions.get(key, 0) > 0 \
+            or self.board.is_insufficient_material()
+
+    def game_repetitions(self):
+        """
+        Returns the occurrences of the positions since the last irreversible move of the game
+        """
+        repetitions = {}
+        board = self.board.copy()
+        for _ in range(min(board.halfmove_clock, len(board.move_stack)) + 1):
+            key = data.zobrist_hash(board)
+            repetitions[key] = repetitions.get(key, 0) + 1
+            if not board.move_stack:
+                break
+            board.pop()
+        return repetitions
+
+    def tt_put(self, key, depth, value, flag, move, ply):
+        # Mate scores are stored relative to the node, not the root
+        if value > MATE_THRESHOLD:
+            value += 0.001 * ply
+        elif value < -MATE_THRESHOLD:
+            value -= 0.001 * ply
+        self.tt.put(key, depth, value, flag, move)
+
+    def tt_get(self, key, ply):
+        """
+        Returns the (depth, value, flag, move) entry of the key with mate scores relative to the root
+        """
+        entry = self.tt.get(key)
+        if entry is None:
+            return None
+        depth, value, flag, move = entry
+        if value > MATE_THRESHOLD:
+            value -= 0.001 * ply
+        elif value < -MATE_THRESHOLD:
+            value += 0.001 * ply
+        return depth, value, flag, move
+
+    def negamax(self, depth, alpha, beta, ply):
+        self.nodes += 1
+        if self.nodes % CHECK_EVERY == 0:
+            self.check_limits()
+        board = self.board
+        key = data.zobrist_hash(board)
+        if ply > 0 and self.is_draw(key):
+            return 0.
+        if depth <= 0:
+            return self.quiescence(alpha, beta, ply, 0)
+
+        tt_move = None
+        entry = self.tt_get(key, ply)
+        if entry is not None:
+            tt_depth, tt_value, tt_flag, tt_move = entry
+            if tt_depth >= depth and ply > 0:
+                if tt_flag == EXACT:
+                    return tt_value
+                elif tt_flag == LOWER:
+                    alpha = max(alpha, tt_value)
+                else:
+                    beta = min(beta, tt_value)
+                if alpha >= beta:
+                    return tt_value
+
+        moves = list(board.generate_legal_moves())
+        if not moves:
+            return -MATE_VALUE + 0.001 * ply if board.is_check() else 0.
+        moves = self.order_moves(moves, key, depth, tt_move)
+        if depth == 1:
+            # The children are the frontier, evaluate them together
+            self.evaluate_children(moves)
+        elif self.policy_model is not None and depth - 1 >= PRIOR_DEPTH:
+            # The children order their moves by priors, predict them together
+            self.predict_priors(moves)
+
+        alpha_orig = alpha
+        best_value = -float("inf")
+        best_move = None
+        self.repetitions[key] = self.repetitions.get(key, 0) + 1
+        try:
+            for move in moves:
+                board.push(move)
+                try:
+                    value = -self.negamax(depth - 1, -beta, -alpha, ply + 1)
+                finally:
+                    board.pop()
+                if value > best_value:
+                    best_value = value
+                    best_move = move
+                    if ply == 0:
+                        self.root_move = move
+                alpha = max(alpha, value)
+                if alpha >= beta:
+                    break
+        finally:
+            self.repetitions[key] -= 1
+
+        flag = UPPER if best_value <= alpha_orig else LOWER if best_value >= beta else EXACT
+        self.tt_put(key, depth, best_value, flag, best_move, ply)
+        return best_value
+
+    def quiescence(self, alpha, beta, ply, qdepth):
+        """
+        Searches captures and promotions until the position is quiet, standing pat on the value network
+        """
+        board = self.board
+        stand_pat = self.evaluate(data.zobrist_hash(board))
+        if stand_pat >= beta or qdepth >= QUIESCENCE_DEPTH:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+
+        moves = [move for move in board.generate_legal_moves() if move.promotion is not None or board.is_capture(move)]
+        if not moves:
+            return alpha
+        moves = self.order_moves(moves, None, 0)
+        self.evaluate_children(moves)
+        for move in moves:
+            self.nodes += 1
+            if self.nodes % CHECK_EVERY == 0:
+                self.check_limits()
+            board.push(move)
+            try:
+                value = -self.quiescence(-beta, -alpha, ply + 1, qdepth + 1)
+            finally:
+                board.pop()
+            if value >= beta:
+                return value
+            alpha = max(alpha, value)
+        return alpha
+
+    def principal_variation(self, depth):
+        """
+        Returns the moves of the transposition table from the current board
+        """
+        pv = []
+        seen = set()
+        for _ in range(depth):
+            key = data.zobrist_hash(self.board)
+            entry = self.tt.get(key)
+            if entry is None or entry[3] is None or key in seen or not self.board.is_legal(entry[3]):
+                break
+            seen.add(key)
+            pv.append(entry[3])
+            self.board.push(entry[3])
+        for _ in pv:
+            self.board.pop()
+        return pv
+
+    def info(self, depth, value, pv):
+        elapsed = time.time() - self.start_time
+        if abs(value) > MATE_THRESHOLD:
+            plies = int(round((MATE_VALUE - abs(value)) / 0.001))
+            score = "mate %d" % ((plies + 1) // 2 if value > 0 else -((plies + 1) // 2))
+        else:
+            score = "cp %d" % int(round(VALUE_TO_CP * value))
+        print("info depth %d score %s nodes %d nps %d time %d hashfull %d pv %s" % \
+              (depth, score, self.nodes, self.nodes / max(elapsed, 1e-3), 1000 * elapsed, self.tt.hashfull(),
+               " ".join(move.uci() for move in pv)), flush=True)
+
+    def search(self):
+        options = self.search_options
+        self.start_time = time.time()
+        budget = self.time_budget()
+        self.deadline = None if budget is None else self.start_time + budget
+        self.max_nodes = options.get("nodes")
+        max_depth = options.get("depth", MAX_DEPTH if budget is not None or self.max_nodes is not None \
+                                         or "infinite" in options else DEFAULT_DEPTH)
+        self.table.new_search()
+        self.tt.new_search()
+        self.nodes = 0
+        self.num_evals = 0
+        self.num_batches = 0
+        self.root_move = None
+        self.repetitions = self.game_repetitions()
+
+        legal_moves = list(self.board.generate_legal_moves())
+        if not legal_moves:
+            self.moves = None
+            return
+        self.moves = [legal_moves[0]]
+
+        for depth in range(1, max_depth + 1):
+            try:
+                value = self.negamax(depth, -float("inf"), float("inf"), 0)
+            except SearchStopped:
+                # Keep the best root move of the unfinished iteration, it was searched first or beat it
+                if self.root_move is not None:
+                    self.moves = [self.root_move]
+                break
+            pv = self.principal_variation(depth) or [self.root_move]
+            self.moves = pv[:2]
+            self.info(depth, value, pv)
+            if abs(value) > MATE_THRESHOLD:
+                break
+            if self.deadline is not None and time.time() - self.start_time > TIME_FRACTION * budget:
+                break
+            self.root_move = None
+
+        elapsed = time.time() - self.start_time
+        print("info string nodes %d nps %d evals %d batches %d" % \
+              (self.nodes, self.nodes / max(elapsed, 1e-3), self.num_evals, self.num_batches), flush=True)
+        self.report_table(hashfull=False)
+
+if __name__ == "__main__":
+    engine = AlphaBetaEngine("./saved/value_network_253.hdf5", "./saved/sl_network_595.hdf5")
+    engine.run()
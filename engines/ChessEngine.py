@@ -3,17 +3,26 @@ import chess
 import sys
 import os
 import random
+import threading
 import traceback
-from concurrent import futures
+
+MOVES_TO_GO = 30  # moves assumed left in sudden death
 
 class ChessEngine:
     def __init__(self):
         self.engine_name = "Dummy Chess Engine"
         self.author = "P. Rajpurkar & T. Migimatsu"
         self.board = chess.Board()
-        self.thread_pool = futures.ThreadPoolExecutor(max_workers=2)
+        # Thread of the running go command, the only one touching the board meanwhile
+        self.search_thread = None
         self.is_black = False
         self.new_game = True
+        self.search_options = {}
+        # Set by stop, searches that take time should poll it and return
+        # with the board as they found it, go then sends the move
+        self.stop_event = threading.Event()
+        # eval_table.EvalTable of network outputs, if the engine uses one
+        self.table = None
 
     ###################
     # Virtual methods #
@@ -44,7 +53,7 @@ class ChessEngine:
         """
         Stop searching/pondering and submit moves
         """
-        pass
+        self.stop_event.set()
 
     def __str__(self):
         return str(self.board)
@@ -91,40 +100,78 @@ class ChessEngine:
             self.board.push_uci(moves[-1])
 
     def go(self, input_tokens=None):
-        # Parse search options
+        # stop_event is cleared by run before the search thread starts, so an early stop is not lost
+        # Parse search options, e.g. "wtime 60000 btime 60000 winc 1000 binc 1000"
         self.search_options = {}
-        if input_tokens[0] == "searchmoves":
-            # Restrict search to this moves only
-            self.search_options["searchmoves"] = input_tokens[1:]
-        elif input_tokens[0] == "ponder":
-            # Start searching in pondering move. Do not exit the search in ponder
-            # mode, even if it's mate! This means that the last move sent in the
-            # position string is the ponder move. The engine can do what it wants to
-            # do, but after a "ponderhit" command it should execute the suggested
-            # move to ponder on.
-            ponder()
-        elif input_tokens[0] in ["movetime", "infinite", "wtime", "btime", \
-                                 "winc", "binc", "movestogo", "depth", "nodes", "mate"]:
-            # wtime: White has x msec left on the clock
-            # btime: Black has x msec left on the clock
-            # winc: White increment per move in mseconds if x > 0
-            # binc: Black increment per move in mseconds if x > 0
-            # movestogo: Here are x moves to the next time control, this will
-            #     only be sent if x > 0, if you don't get this and get the wtime and
-            #     btime it's sudden death
-            # depth: Search x plies only
-            # nodes: Search x nodes only
-            # mate: Search for a mate in x moves
-            # movetime: Search exactly x mseconds
-            self.search_options[input_tokens[0]] = int(input_tokens[1])
-        elif input_tokens[0] == "infinite":
-            # Search until the "stop" command. Do not exit the search without being
-            # told so in this mode!
-            self.search_options["infinite"] = True
+        input_tokens = input_tokens or []
+        i = 0
+        while i < len(input_tokens):
+            token = input_tokens[i]
+            if token == "searchmoves":
+                # Restrict search to this moves only
+                self.search_options["searchmoves"] = input_tokens[i+1:]
+                break
+            elif token == "ponder":
+                # Start searching in pondering move. Do not exit the search in ponder
+                # mode, even if it's mate! This means that the last move sent in the
+                # position string is the ponder move. The engine can do what it wants to
+                # do, but after a "ponderhit" command it should execute the suggested
+                # move to ponder on.
+                self.search_options["ponder"] = True
+            elif token == "infinite":
+                # Search until the "stop" command. Do not exit the search without being
+                # told so in this mode!
+                self.search_options["infinite"] = True
+            elif token in ["movetime", "wtime", "btime", \
+                           "winc", "binc", "movestogo", "depth", "nodes", "mate"]:
+                # wtime: White has x msec left on the clock
+                # btime: Black has x msec left on the clock
+                # winc: White increment per move in mseconds if x > 0
+                # binc: Black increment per move in mseconds if x > 0
+                # movestogo: Here are x moves to the next time control, this will
+                #     only be sent if x > 0, if you don't get this and get the wtime and
+                #     btime it's sudden death
+                # depth: Search x plies only
+                # nodes: Search x nodes only
+                # mate: Search for a mate in x moves
+                # movetime: Search exactly x mseconds
+                self.search_options[token] = int(input_tokens[i+1])
+                i += 1
+            i += 1
 
         self.search()
         self.send_move()
 
+    def time_budget(self):
+        """
+        Returns the seconds to spend on this move from movetime or the clock, None if unlimited
+        """
+        options = self.search_options
+        if "infinite" in options:
+            return None
+        if "movetime" in options:
+            return options["movetime"] / 1000.
+        clock = options.get("btime" if self.board.turn == chess.BLACK else "wtime")
+        if clock is None:
+            return None
+        increment = options.get("binc" if self.board.turn == chess.BLACK else "winc", 0)
+        moves_to_go = options.get("movestogo", MOVES_TO_GO)
+        return min(clock / moves_to_go + 0.8 * increment, 0.5 * clock) / 1000.
+
+    def report_table(self, hashfull=True):
+        """
+        Sends the fill and hit rate of the evaluation table
+        - hashfull: send the fill as info hashfull, False for engines whose
+                    hashfull is their own transposition table
+        """
+        if self.table is None:
+            return
+        if hashfull:
+            fill = "info hashfull %d string evaluation table" % self.table.hashfull()
+        else:
+            fill = "info string evaluation table full %d permille," % self.table.hashfull()
+        print("%s hits %.1f%% of %d probes" % (fill, 100 * self.table.hit_rate(), self.table.num_probes), flush=True)
+
     def send_move(self):
         # Send two best moves
         if not self.moves:
@@ -134,14 +181,35 @@ class ChessEngine:
         else:
             print("bestmove", self.moves[0], "ponder", self.moves[1])
 
+    def wait_search(self):
+        """
+        Waits for the running search to send its move and unwind the board
+        """
+        if self.search_thread is not None:
+            self.search_thread.join()
+            self.search_thread = None
+
     def run(self):
         while True:
             try:
                 input_msg = input()
-                self.thread_pool.submit(self.handle_msg, input_msg)
             except:
                 self.exit()
                 return
+            if input_msg.startswith("go"):
+                # Search in its own thread so that stop and isready are answered meanwhile
+                self.wait_search()
+                self.stop_event.clear()
+                self.search_thread = threading.Thread(target=self.handle_msg, args=(input_msg,))
+                self.search_thread.daemon = True
+                self.search_thread.start()
+                continue
+            if input_msg not in ("stop", "isready", "quit"):
+                # Every other command reads or changes the board
+                self.wait_search()
+            self.handle_msg(input_msg)
+            if input_msg == "quit":
+                return
 
     def handle_msg(self, input_msg):
         try:
@@ -155,7 +223,6 @@ class ChessEngine:
                 self.go(input_msg.split(' ')[1:])
             elif input_msg == "stop":
                 self.stop()
-                self.send_move()
             elif input_msg == "uci":
                 self.uci()
             elif input_msg == "ucinewgame":
@@ -176,7 +243,7 @@ class ChessEngine:
 
     def exit(self):
         self.stop()
-        self.thread_pool.shutdown()
+        self.wait_search()
 
 if __name__ == "__main__":
     engine = ChessEngine()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+from keras.models import load_model
+import numpy as np
+import sys
+import time
+sys.path.append('.')
+from engines.ChessEngine import ChessEngine
+import chess
+import data
+import eval_table
+
+C_PUCT = 1.5
+VIRTUAL_LOSS = 1
+BATCH_SIZE = 16  # leaves evaluated per predict
+DEFAULT_NODES = 800  # simulations when go has no time or node limit
+VALUE_TO_CP = 1000  # centipawns reported per unit of value
+INFO_EVERY = 1.  # seconds between info lines
+
+class Node:
+    """
+    Expanded position with the statistics of its edges
+    - moves: legal moves, or empty for a finished game
+    - P: prior probabilities of the moves from the policy network
+    - N, W: visit counts and total values of the edges, from the side to move
+    - value: value of a finished game from the side to move, None otherwise
+    """
+    __slots__ = ("moves", "P", "N", "W", "children", "value")
+
+    def __init__(self, moves, priors, value=None):
+        self.moves = moves
+        self.P = priors
+        self.N = np.zeros(len(moves))
+        self.W = np.zeros(len(moves))
+        self.children = [None] * len(moves)
+        self.value = value
+
+    def select(self, c_puct=C_PUCT):
+        """
+        Returns the edge maximizing Q + U, unvisited edges counting as Q = 0
+        """
+        Q = self.W / np.maximum(self.N, 1)
+        U = c_puct * self.P * np.sqrt(self.N.sum() + 1) / (1 + self.N)
+        return int(np.argmax(Q + U))
+
+class MCTSEngine(ChessEngine):
+    """
+    Monte-Carlo tree search with PUCT selection over the policy and value networks
+
+    Each round descends batch_size simulations from the root. Virtual loss
+    on the edges they pass steers the following simulations elsewhere, and
+    the new leaves of the round are evaluated by one batched predict of each
+    network before the results are backed up. Network outputs are kept in an
+    eval_table.EvalTable, so transpositions and positions of earlier searches
+    are not predicted again.
+    - limits: nodes (simulations), movetime, wtime/btime with winc/binc/movestogo,
+              infinite until stop
+    """
+    def __init__(self, policy_hdf5, value_hdf5, featurized=True, batch_size=BATCH_SIZE, c_puct=C_PUCT, table=None):
+        """
+        - table: eval_table.EvalTable of values and policies from the side to
+                 move, shared by engines of the same networks if None
+        """
+        super().__init__()
+        self.engine_name = "MCTS Policy Value Engine"
+        self.policy_model = load_model(policy_hdf5)
+        self.value_model = load_model(value_hdf5)
+        self.featurized = featurized
+        self.batch_size = batch_size
+        self.c_puct = c_puct
+        self.table = table if table is not None else \
+            eval_table.shared_table((value_hdf5, policy_hdf5, featurized))
+        self.moves = None
+
+    def evaluate(self, leaves):
+        """
+        Returns (priors, values) of leaves given as (key, bitboards, moves, black),
+        predicting the leaves missing from the table in one predict per network
+        """
+        keys = np.array([key for key, _, _, _ in leaves], dtype=np.uint64)
+        value_hits, values = self.table.probe_values(keys)
+        policy_hits, policies = self.table.probe_policies(keys)
+        idx_missing = np.flatnonzero(~(value_hits & policy_hits))
+        if len(idx_missing):
+            X = data.featurize_bitboards(np.array([leaves[i][1] for i in idx_missing]), featurized=self.featurized)
+            values[idx_missing] = self.value_model.predict(X, batch_size=len(X), verbose=0).flatten()
+            y_from, y_to = self.policy_model.predict(X, batch_size=len(X), verbose=0)
+            policies[idx_missing] = np.concatenate([y_from, y_to], axis=1)
+            self.table.store(keys[idx_missing], values=values[idx_missing], policies=policies[idx_missing])
+        y_from, y_to = policies[:,:data.NUM_SQUARES], policies[:,data.NUM_SQUARES:]
+
+        priors = []
+        for i, (_, _, moves, black) in enumerate(leaves):
+            idx = np.array([data.index_from_move(move, black=black) for move in moves])
+            p = y_from[i, idx // data.NUM_SQUARES] * y_to[i, idx % data.NUM_SQUARES]
+            p = np.nan_to_num(p.astype(np.float64))
+            priors.append(p / p.sum() if p.sum() > 0 else np.full(len(moves), 1. / len(moves)))
+        return priors, values.tolist()
+
+    def leaf(self):
+        """
+        Returns the (key, bitboards, moves, black) of the current board for evaluate
+        """
+        black = self.board.turn == chess.BLACK
+        return data.zobrist_hash(self.board), data.bitboards_from_board(self.board, black=black), \
+            list(self.board.generate_legal_moves()), black
+
+    def finished_value(self):
+        """
+        Returns the value of a finished game from the side to move, None if it goes on
+        """
+        board = self.board
+        if board.halfmove_clock >= 100 or board.is_insufficient_material():
+            return 0.
+        if not any(board.generate_legal_moves()):
+            return -1. if board.is_check() else 0.
+        return None
+
+    def descend(self, root):
+        """
+        Follows PUCT from the root with virtual loss until an unexpanded edge or a finished game
+        - returns the path of (node, edge) and the node reached, None if unexpanded
+        - leaves the board at the position reached
+        """
+        node = root
+        path = []
+        while node is not None and node.value is None:
+            a = node.select(self.c_puct)
+            node.N[a] += VIRTUAL_LOSS
+            node.W[a] -= VIRTUAL_LOSS
+            path.append((node, a))
+            self.board.push(node.moves[a])
+            node = node.children[a]
+        return path, node
+
+    def backup(self, path, value):
+        """
+        Replaces the virtual losses of the path by one visit with the value of
+        its leaf, which is from the side to move at the leaf
+        """
+        for node, a in reversed(path):
+            value = -value
+            node.N[a] += 1 - VIRTUAL_LOSS
+            node.W[a] += value + VIRTUAL_LOSS
+
+    def undo(self, path):
+        for node, a in path:
+            node.N[a] -= VIRTUAL_LOSS
+            node.W[a] += VIRTUAL_LOSS
+
+    def principal_variation(self, root):
+        pv = []
+        node = root
+        while node is not None and len(node.moves) > 0 and node.N.max() > 0:
+            a = int(np.argmax(node.N))
+            pv.append(node.moves[a])
+            node = node.children[a]
+        return pv
+
+    def info(self, root):
+        elapsed = time.time() - self.start_time
+        a = int(np.argmax(root.N))
+        q = root.W[a] / max(root.N[a], 1)
+        print("info depth %d seldepth %d score cp %d nodes %d nps %d time %d hashfull %d pv %s" % \
+              (len(self.principal_variation(root)), self.seldepth, int(round(VALUE_TO_CP * q)), self.nodes,
+               self.nodes / max(elapsed, 1e-3), 1000 * elapsed, self.table.hashfull(),
+               " ".join(move.uci() for move in self.principal_variation(root))), flush=True)
+
+    def search(self):
+        options = self.search_options
+        self.start_time = time.time()
+        budget = self.time_budget()
+        deadline = None if budget is None else self.start_time + budget
+        max_nodes = options.get("nodes")
+        if max_nodes is None and budget is None and "infinite" not in options:
+            max_nodes = DEFAULT_NODES
+        self.table.new_search()
+        self.nodes = 0
+        self.seldepth = 0
+
+        if self.finished_value() is not None:
+            self.moves = None
+            return
+        leaf = self.leaf()
+        [priors], _ = self.evaluate([leaf])
+        root = Node(leaf[2], priors)
+        self.moves = [root.moves[int(np.argmax(root.P))]]
+        time_info = self.start_time
+
+        # Playouts push and pop on self.board, which go hands back unwound with the move
+        num_plies = len(self.board.move_stack)
+        try:
+            while not self.stop_event.is_set() \
+                  and (max_nodes is None or self.nodes < max_nodes) \
+                  and (deadline is None or time.time() < deadline):
+                # Descend a round of simulations, collecting the new leaves
+                paths = []
+                leaves = []
+                expanding = set()
+                num_simulations = self.batch_size if max_nodes is None else min(self.batch_size, max_nodes - self.nodes)
+                for _ in range(num_simulations):
+                    path, node = self.descend(root)
+                    self.seldepth = max(self.seldepth, len(path))
+                    if node is not None:
+                        # Finished game already in the tree
+                        self.backup(path, node.value)
+                        self.nodes += 1
+                    else:
+                        parent, a = path[-1]
+                        value = self.finished_value()
+                        if value is not None:
+                            parent.children[a] = Node([], np.zeros(0), value=value)
+                            self.backup(path, value)
+                            self.nodes += 1
+                        elif (id(parent), a) in expanding:
+                            # Another simulation of this round already reached the leaf
+                            self.undo(path)
+                        else:
+                            expanding.add((id(parent), a))
+                            paths.append(path)
+                            leaves.append(self.leaf())
+                    for _ in path:
+                        self.board.pop()
+
+                if leaves:
+                    priors, values = self.evaluate(leaves)
+                    for path, (_, _, moves, _), p, value in zip(paths, leaves, priors, values):
+                        parent, a = path[-1]
+                        parent.children[a] = Node(moves, p)
+                        self.backup(path, value)
+                    self.nodes += len(leaves)
+                # Most visited move so far, sent if a stop command arrives
+                self.moves = [root.moves[int(np.argmax(root.N))]]
+
+                if time.time() - time_info > INFO_EVERY:
+                    time_info = time.time()
+                    self.info(root)
+        finally:
+            while len(self.board.move_stack) > num_plies:
+                self.board.pop()
+
+        pv = self.principal_variation(root)
+        if pv:
+            self.moves = pv[:2]
+        self.info(root)
+        self.report_table()
+
+if __name__ == "__main__":
+    engine = MCTSEngine("./saved/sl_network_595.hdf5", "./saved/value_network_253.hdf5")
+    engine.run()
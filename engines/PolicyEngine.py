@@ -8,11 +8,46 @@ import data
 import random
 import traceback
 
-NUM_TRIES = 20
+SELECTION_MODES = ("greedy", "sample", "top_k")
+
+def select_moves(y_from, y_to, mask, mode="sample", temperature=1., top_k=5):
+    """
+    Returns one (from * 64 + to) index per board from the legal joint from x to probabilities
+    - mask: bool [N x 4096] of legal moves from data.legal_move_masks
+    - mode: greedy takes the most likely legal move, sample draws from the
+            renormalised probabilities sharpened by 1 / temperature, top_k
+            samples the same way among the top_k legal moves only
+    - boards whose legal moves all have zero or NaN probability draw uniformly among them
+    """
+    if mode not in SELECTION_MODES:
+        raise ValueError("Unknown selection mode " + str(mode))
+    p = (y_from[:,:,None].astype(np.float64) * y_to[:,None,:]).reshape(mask.shape)
+    p = np.where(mask, np.nan_to_num(p), 0.)
+    p = np.where((p.max(axis=1) > 0)[:,None], p, mask)
+    if mode == "greedy":
+        return np.argmax(p, axis=1)
+
+    if mode == "top_k" and top_k < p.shape[1]:
+        kth = -np.partition(-p, top_k - 1, axis=1)[:,top_k-1:top_k]
+        p = np.where(p >= kth, p, 0.)
+    # Scale by the row maximum first so that low temperatures do not underflow
+    p = (p / p.max(axis=1, keepdims=True)) ** (1. / temperature)
+    cdf = np.cumsum(p, axis=1)
+    u = np.random.random_sample((p.shape[0], 1)) * cdf[:,-1:]
+    return np.argmax(cdf > u, axis=1)
 
 class PolicyEngine(ChessEngine):
-    def __init__(self, model_hdf5=None, black=False):
+    def __init__(self, model_hdf5=None, black=False, mode="sample", temperature=1., top_k=5, table=None):
+        """
+        - mode, temperature, top_k: move selection as in select_moves
+        - table: eval_table.EvalTable caching the policy per position, None by
+                 default since policy_rl trains the model between searches
+        """
         super().__init__()
+        self.table = table
+        self.mode = mode
+        self.temperature = temperature
+        self.top_k = top_k
         if model_hdf5 is not None:
             self.model = load_model(model_hdf5)
             self.is_black = black
@@ -23,71 +58,47 @@ class PolicyEngine(ChessEngine):
 
         # Create X batch
         batch_size = len(boards)
-        states = [data.state_from_board(board, featurized=True, black=self.is_black) for board in boards]
-        X = np.array(states)
+        X = data.featurize_boards(boards, black=self.is_black)
 
-        moves = []
-        y_from = []
-        y_to = []
-        num_random = 0
+        # Legal moves of the whole batch
+        mask, lookup = data.legal_move_masks(boards, black=self.is_black)
+        if not mask.any(axis=1).all():
+            self.moves = None
+            return
 
         # Predict batch
         try:
-            y_hat_from, y_hat_to = self.model.predict(X, batch_size=batch_size, verbose=0)
-            for i, board in enumerate(boards):
-                # Multiply probabilities
-                p = np.outer(y_hat_from[i], y_hat_to[i])
-                p_shape = p.shape
-                p = p.reshape((-1,))
-
-                # Find max probability action
-                move = None
-                num_non_nan = np.count_nonzero(~np.isnan(p))
-                if num_non_nan == 0:
-                    #  print("WARNING: Model predictions are all NaN", file=sys.stderr)
-                    with open("nan_log", "w") as f:
-                        f.write("NANNNNNNNN")
-                    raise Exception("WARNING: Model predictions are all NaN")
-                idx_random = np.random.choice(p.shape[0], min(NUM_TRIES, np.count_nonzero(p), num_non_nan), replace=False, p=p)
-                for idx in idx_random:
-                    from_square, to_square = np.unravel_index(idx, p_shape)
-                    move_attempt = data.move_from_action(from_square, to_square, black=self.is_black)
-                    if board.is_legal(move_attempt):
-                        move = move_attempt
-                        break
-                if move is None:
-                    num_random += 1
-                    legal_moves = list(board.generate_legal_moves())
-                    if len(legal_moves) == 0:
-                        self.moves = None
-                        return
-                    move = random.choice(legal_moves)
-                moves.append(move)
-                a_from, a_to = data.action_from_move(move, black=self.is_black)
-                y_from.append(a_from)
-                y_to.append(a_to)
-            
-            # Return moves for UCI
-            if moves:
-                self.moves = [moves[0]]
-            else:
-                self.moves = None
+            y_hat_from, y_hat_to = self.predict(boards, X)
+            actions = select_moves(y_hat_from, y_hat_to, mask, mode=self.mode,
+                                   temperature=self.temperature, top_k=self.top_k)
         except Exception as e:
             with open("policy_engine_error.log", "w+") as f:
-                f.write("error")
-            for i, board in enumerate(boards):
-                move = random.choice(list(board.generate_legal_moves()))
-                moves.append(move)
-                a_from, a_to = data.action_from_move(move, black=self.is_black)
-                y_from.append(a_from)
-                y_to.append(a_to)
-                num_random += 1
+                f.write(traceback.format_exc())
+            actions = np.array([random.choice(list(moves)) for moves in lookup])
+        moves = [moves[idx] for moves, idx in zip(lookup, actions.tolist())]
 
-        # print("Random moves: %d out of %d" % (num_random, batch_size), "black" if self.is_black else "white")
-        y_from = np.array(y_from)
-        y_to = np.array(y_to)
+        # Return moves for UCI
+        self.moves = [moves[0]]
+
+        # Expand the move indices to one-hot labels for the whole batch at once
+        _, [y_from, y_to] = data.unpack_actions(X, actions.astype(np.uint16))
         return X, [y_from, y_to], moves
 
+    def predict(self, boards, X):
+        """
+        Returns (y_from, y_to) of the boards, predicting only those missing from the table
+        """
+        if self.table is None:
+            return self.model.predict(X, batch_size=len(X), verbose=0)
+        keys = np.array([data.zobrist_hash(board) for board in boards], dtype=np.uint64)
+        hits, policies = self.table.probe_policies(keys)
+        idx_missing = np.flatnonzero(~hits)
+        if len(idx_missing):
+            y_from, y_to = self.model.predict(X[idx_missing], batch_size=len(idx_missing), verbose=0)
+            policies[idx_missing] = np.concatenate([y_from, y_to], axis=1)
+            self.table.store(keys[idx_missing], policies=policies[idx_missing])
+        return policies[:,:data.NUM_SQUARES], policies[:,data.NUM_SQUARES:]
+
 if __name__ == "__main__":
     engine = PolicyEngine("./saved/sl_network_595.hdf5")
     engine.run()
@@ -5,30 +5,52 @@ import numpy as np
 import sys
 sys.path.append('.')
 import data
+import eval_table
 
 class ValueEngine(ChessEngine):
-    def __init__(self, keras_model_h5, black=False):
+    def __init__(self, keras_model_h5, black=False, table=None):
+        """
+        - table: eval_table.EvalTable of child values, kept across moves and
+                 games, shared by engines of the same model and side if None
+        """
         super().__init__()
         self.model = load_model(keras_model_h5)
         self.is_black = black
+        self.X = None
+        # Children are valued from the engine's side, so the side is part of the table name
+        self.table = table if table is not None else \
+            eval_table.shared_table(("ValueEngine", keras_model_h5, black), policy_size=0)
 
     def search(self):
+        self.table.new_search()
         moves = []
-        scores = []
-        states = []
+        keys = []
+        bitboards = []
         for move in self.board.generate_legal_moves():
-            # Play move and convert board to state
-            test_board = self.board.copy()
-            test_board.push(move)
-            state = data.state_from_board(test_board, black=self.is_black)
-            states.append(state)
+            # Play move in place
+            self.board.push(move)
+            keys.append(data.zobrist_hash(self.board))
+            bitboards.append(data.bitboards_from_board(self.board, black=self.is_black))
+            self.board.pop()
             moves.append(move)
-            scores = self.model.predict(np.array(states)).flatten().tolist()
-        if (len(scores) == 0):
+        if not moves:
             self.moves = None
             return
+
+        hits, scores = self.table.probe_values(keys)
+        idx_missing = np.flatnonzero(~hits)
+        if len(idx_missing):
+            # Convert the uncached children to states in a reused buffer and predict them at once
+            if self.X is None or self.X.shape[0] < len(idx_missing):
+                self.X = np.empty((len(idx_missing), data.NUM_COLORS * data.NUM_PIECES, data.NUM_ROWS, data.NUM_COLS), dtype=np.float32)
+            X = data.featurize_bitboards(np.array(bitboards)[idx_missing], featurized=False, out=self.X[:len(idx_missing)])
+            values = self.model.predict(X, batch_size=len(idx_missing), verbose=0).flatten()
+            scores[idx_missing] = values
+            self.table.store(np.array(keys, dtype=np.uint64)[idx_missing], values=values)
+
         idx = np.argmax(scores)
         self.moves = [moves[idx]]
+        self.report_table()
 
 
 if __name__ == "__main__":
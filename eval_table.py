@@ -0,0 +1,147 @@
+import numpy as np
+
+TABLE_SIZE = 2**16  # entries, in buckets of BUCKET_SIZE
+BUCKET_SIZE = 2
+POLICY_SIZE = 2 * 64  # from and to heads of the policy network
+
+# Entry flags
+HAS_VALUE = 1
+HAS_POLICY = 2
+
+class EvalTable:
+    """
+    Fixed-size table of network outputs keyed by Zobrist hash
+
+    Entries live in preallocated arrays, so the memory use is fixed up
+    front: values and policies are stored as float16. Each key maps to a
+    bucket of BUCKET_SIZE entries by its low bits and a new key replaces,
+    in order, the entry of the same key, an empty entry, or the entry least
+    recently used by generation, where engines start a generation per search.
+    - policy_size: floats per policy vector, 0 for a value-only table
+    - probe_values/probe_policies and store take arrays of keys so that a
+      batch of positions costs one lookup
+    """
+    def __init__(self, size=TABLE_SIZE, policy_size=POLICY_SIZE):
+        num_buckets = 1
+        while num_buckets * BUCKET_SIZE < size:
+            num_buckets *= 2
+        self.mask = np.uint64(num_buckets - 1)
+        self.keys = np.zeros((num_buckets, BUCKET_SIZE), dtype=np.uint64)
+        self.flags = np.zeros((num_buckets, BUCKET_SIZE), dtype=np.uint8)
+        self.generations = np.zeros((num_buckets, BUCKET_SIZE), dtype=np.uint16)
+        self.values = np.zeros((num_buckets, BUCKET_SIZE), dtype=np.float16)
+        self.policies = np.zeros((num_buckets, BUCKET_SIZE, policy_size), dtype=np.float16) if policy_size else None
+        self.generation = 0
+        self.num_probes = 0
+        self.num_hits = 0
+
+    def __len__(self):
+        return self.keys.size
+
+    def new_search(self):
+        self.generation = (self.generation + 1) % 2**16
+
+    def _lookup(self, keys):
+        """
+        Returns (keys, buckets, matching entries [N x BUCKET_SIZE]) of the keys
+        """
+        keys = np.asarray(keys, dtype=np.uint64).reshape(-1)
+        buckets = (keys & self.mask).astype(np.intp)
+        match = (self.flags[buckets] != 0) & (self.keys[buckets] == keys[:,None])
+        return keys, buckets, match
+
+    def _probe(self, keys, flag):
+        keys, buckets, match = self._lookup(keys)
+        slots = np.argmax(match, axis=1)
+        hits = match.any(axis=1) & ((self.flags[buckets, slots] & flag) != 0)
+        self.generations[buckets[hits], slots[hits]] = self.generation
+        self.num_probes += len(keys)
+        self.num_hits += int(np.count_nonzero(hits))
+        return hits, buckets, slots
+
+    def probe_values(self, keys):
+        """
+        Returns (hits, values) of the keys, values are undefined where hits is False
+        """
+        hits, buckets, slots = self._probe(keys, HAS_VALUE)
+        return hits, self.values[buckets, slots].astype(np.float32)
+
+    def probe_policies(self, keys):
+        """
+        Returns (hits, policies [N x policy_size]) of the keys, policies are undefined where hits is False
+        """
+        hits, buckets, slots = self._probe(keys, HAS_POLICY)
+        return hits, self.policies[buckets, slots].astype(np.float32)
+
+    def store(self, keys, values=None, policies=None):
+        """
+        Stores values and/or policies of the keys, merging with an entry of the same key
+        - keys of one batch that share a bucket are stored in turn, so they
+          fill its entries instead of overwriting each other, and later
+          outputs of a repeated key or of an overfull bucket win
+        """
+        keys = np.asarray(keys, dtype=np.uint64).reshape(-1)
+        if values is not None:
+            values = np.asarray(values, dtype=np.float32).reshape(-1)
+        if policies is not None:
+            policies = np.asarray(policies, dtype=np.float32).reshape(len(keys), -1)
+
+        # Last occurrence of every key, in batch order
+        _, idx_last = np.unique(keys[::-1], return_index=True)
+        idx = np.sort(len(keys) - 1 - idx_last)
+        while len(idx):
+            # One key per bucket, its first remaining one in batch order
+            _, idx_first = np.unique(keys[idx] & self.mask, return_index=True)
+            batch = idx[idx_first]
+            self._store(keys[batch],
+                        None if values is None else values[batch],
+                        None if policies is None else policies[batch])
+            idx = np.delete(idx, idx_first)
+
+    def _store(self, keys, values, policies):
+        """
+        Stores keys of distinct buckets
+        """
+        keys, buckets, match = self._lookup(keys)
+        # Prefer the same key, then an empty entry, then the oldest generation
+        age = (self.generation - self.generations[buckets].astype(np.int64)) % 2**16
+        priority = np.where(match, 2**18, np.where(self.flags[buckets] == 0, 2**17, age))
+        slots = np.argmax(priority, axis=1)
+        flags = np.where(match.any(axis=1), self.flags[buckets, slots], 0).astype(np.uint8)
+
+        self.keys[buckets, slots] = keys
+        self.generations[buckets, slots] = self.generation
+        if values is not None:
+            self.values[buckets, slots] = values
+            flags |= HAS_VALUE
+        if policies is not None:
+            self.policies[buckets, slots] = policies
+            flags |= HAS_POLICY
+        self.flags[buckets, slots] = flags
+
+    def hashfull(self):
+        """
+        Returns the permille of used entries as reported by UCI info hashfull
+        """
+        return int(1000 * np.count_nonzero(self.flags) // self.flags.size)
+
+    def hit_rate(self):
+        return self.num_hits / max(self.num_probes, 1)
+
+    def clear(self):
+        self.flags[:] = 0
+        self.num_probes = 0
+        self.num_hits = 0
+
+_tables = {}
+
+def shared_table(name, size=TABLE_SIZE, policy_size=POLICY_SIZE):
+    """
+    Returns the table registered under name, creating it on first use
+    - name: identifies the networks and input convention of the outputs,
+            e.g. the model files, so that engines in one process running the
+            same networks share their evaluations across searches and games
+    """
+    if name not in _tables:
+        _tables[name] = EvalTable(size=size, policy_size=policy_size)
+    return _tables[name]
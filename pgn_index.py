@@ -0,0 +1,99 @@
+import os
+import re
+import numpy as np
+from tqdm import tqdm
+import compressed
+
+# One record per game in the PGN
+# - offset: byte offset of the game's first header line
+# - ply_count: PlyCount header, 0 if missing
+# - result: 1, -1, 0 for 1-0, 0-1, and anything else
+# - forfeit: the last comment of the movetext mentions a forfeit
+INDEX_DTYPE = np.dtype([("offset", "<u8"),
+                        ("ply_count", "<u2"),
+                        ("result", "i1"),
+                        ("forfeit", "?")])
+
+RESULTS = {"1-0": 1, "0-1": -1}
+
+HEADER_REGEX = re.compile(br'^\[(\w+)\s+"(.*)"\]\s*$')
+# Every SAN move has a letter, while move numbers and results do not
+MOVE_REGEX = re.compile(br"[a-zA-Z]")
+
+def index_filename(filename):
+    return filename + ".index.npy"
+
+def build_index(filename):
+    """
+    Scans the PGN once without parsing movetext and returns its INDEX_DTYPE records
+    - offsets of compressed PGNs are positions in the decompressed stream
+    """
+    games = []
+    offset = 0
+    in_headers = False
+    # Comments may span lines, and lines inside them are never headers
+    in_comment = False
+    comment = []
+    with compressed.open_input(filename, binary=True) as pgn:
+        for line in tqdm(pgn, desc="Indexing " + os.path.basename(filename)):
+            if not in_comment and line.startswith(b"["):
+                if not in_headers:
+                    # First header line of a new game
+                    games.append([offset, 0, 0, False])
+                    in_headers = True
+                matches = HEADER_REGEX.match(line)
+                if matches is not None:
+                    key, value = matches.groups()
+                    if key == b"PlyCount" and value.isdigit():
+                        games[-1][1] = min(int(value), np.iinfo(np.uint16).max)
+                    elif key == b"Result":
+                        games[-1][2] = RESULTS.get(value.decode(), 0)
+            elif in_comment or line.strip():
+                in_headers = False
+                # Only a comment with no move after it belongs to the last node
+                pos = 0
+                while pos < len(line):
+                    if in_comment:
+                        end = line.find(b"}", pos)
+                        if end < 0:
+                            comment.append(line[pos:])
+                            break
+                        comment.append(line[pos:end])
+                        in_comment = False
+                        if games:
+                            games[-1][3] = b"forfeit" in b"".join(comment)
+                        pos = end + 1
+                    else:
+                        start = line.find(b"{", pos)
+                        movetext = line[pos:] if start < 0 else line[pos:start]
+                        if games and MOVE_REGEX.search(movetext):
+                            games[-1][3] = False
+                        if start < 0:
+                            break
+                        in_comment = True
+                        comment = []
+                        pos = start + 1
+            offset += len(line)
+    return np.array([tuple(game) for game in games], dtype=INDEX_DTYPE)
+
+def load_index(filename, refresh=False):
+    """
+    Returns the game index saved next to the PGN, building it if missing or stale
+    """
+    filename_index = index_filename(filename)
+    if not refresh and os.path.isfile(filename_index) \
+       and os.path.getmtime(filename_index) >= os.path.getmtime(filename):
+        return np.load(filename_index)
+
+    index = build_index(filename)
+    np.save(filename_index, index)
+    return index
+
+def filter_index(index, min_plies=0, forfeit=False):
+    """
+    Returns the index records of games with at least min_plies plies, dropping forfeits
+    """
+    mask = index["ply_count"] >= min_plies
+    if not forfeit:
+        mask &= ~index["forfeit"]
+    return index[mask]
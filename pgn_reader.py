@@ -0,0 +1,108 @@
+import re
+import chess
+
+HEADER_REGEX = re.compile(r'^\[(\w+)\s+"(.*)"\]\s*$')
+# Results come before move numbers so "1-0" is not read as move 1,
+# and castling with zeros before move numbers for the same reason
+MOVETEXT_REGEX = re.compile(r"""
+    (?P<comment>\{[^}]*\}?)
+  | (?P<line_comment>;.*)
+  | (?P<open>\()
+  | (?P<close>\))
+  | (?P<result>1-0|0-1|1/2-1/2|\*)
+  | (?P<san>[O0]-[O0](?:-[O0])?[+#]?|[a-zA-Z][^\s{}();$!?]*)
+  | (?P<number>\d+\.*)
+  | (?P<nag>\$\d+|[!?]+)
+""", re.VERBOSE)
+
+class MainlineGame:
+    """
+    Headers, mainline SAN moves and final comment of a PGN game
+
+    Lighter stand-in for chess.pgn.Game: no GameNode tree is built and the
+    moves stay as SAN until the caller parses them against its own board.
+    - headers: dict of the tag pairs
+    - moves: list of SAN strings of the mainline
+    - comment: comment after the last mainline move, "" if none
+    """
+    def __init__(self, headers, moves, comment):
+        self.headers = headers
+        self.moves = moves
+        self.comment = comment
+
+    def board(self):
+        """
+        Returns the starting position of the game
+        """
+        if "FEN" in self.headers:
+            return chess.Board(self.headers["FEN"])
+        return chess.Board()
+
+def read_mainline(pgn):
+    """
+    Reads the next game from a text PGN handle, returning None at EOF
+
+    Variations, NAGs and move numbers are skipped. The movetext ends at its
+    result token or at the first blank line outside a comment.
+    """
+    line = pgn.readline()
+    while line and not line.strip():
+        line = pgn.readline()
+    if not line:
+        return None
+
+    headers = {}
+    while line.startswith("["):
+        matches = HEADER_REGEX.match(line)
+        if matches is not None:
+            headers[matches.group(1)] = matches.group(2)
+        line = pgn.readline()
+
+    moves = []
+    comment = ""
+    comment_lines = None
+    depth = 0
+    while line:
+        pos = 0
+        if comment_lines is not None:
+            # Inside a multi-line comment
+            end = line.find("}")
+            if end < 0:
+                comment_lines.append(line.strip())
+                line = pgn.readline()
+                continue
+            comment_lines.append(line[:end].strip())
+            if depth == 0:
+                comment = " ".join(comment_lines).strip()
+            comment_lines = None
+            pos = end + 1
+        elif not line.strip():
+            if moves or comment:
+                break
+            line = pgn.readline()
+            continue
+
+        matches = MOVETEXT_REGEX.search(line, pos)
+        while matches is not None:
+            kind = matches.lastgroup
+            if kind == "result" and depth == 0:
+                return MainlineGame(headers, moves, comment)
+            elif kind == "comment":
+                token = matches.group()
+                if not token.endswith("}"):
+                    comment_lines = [token[1:].strip()]
+                    break
+                if depth == 0:
+                    comment = token[1:-1].strip()
+            elif kind == "line_comment":
+                break
+            elif kind == "open":
+                depth += 1
+            elif kind == "close":
+                depth = max(depth - 1, 0)
+            elif kind == "san" and depth == 0:
+                moves.append(matches.group())
+                comment = ""
+            matches = MOVETEXT_REGEX.search(line, matches.end())
+        line = pgn.readline()
+    return MainlineGame(headers, moves, comment)
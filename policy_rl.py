@@ -1,4 +1,5 @@
 from engines.PolicyEngine import PolicyEngine
+from prefetch import Prefetcher
 import chess
 import numpy as np
 import os
@@ -48,8 +49,25 @@ def get_result(board):
 class SelfPlayController:
 
     def __init__(self, white_engine, black_engine):
+        """
+        - white_engine: self-play copy of the model being trained, updated
+                        through sync_weights rather than trained directly
+        """
         self.white_engine = white_engine
         self.black_engine = black_engine
+        self.pending_weights = None
+
+    def sync_weights(self, weights):
+        """
+        Hands trained weights to self-play, which loads them before its next white move
+        - weights: model.get_weights() of the training model
+        """
+        self.pending_weights = weights
+
+    def load_pending_weights(self):
+        weights, self.pending_weights = self.pending_weights, None
+        if weights is not None:
+            self.white_engine.model.set_weights(weights)
 
     def play_engine_move(self, engine, states, actions_from, actions_to):
         X, [y_from, y_to], moves = engine.search(self.boards)
@@ -117,7 +135,23 @@ class SelfPlayController:
                 print("White: %d   Black: %d   Draw: %d   Endless: %d" % tuple(self.scoreboard))
 
 
-    def play_generator(self):
+    def play_generator(self, batches=None):
+        """
+        Yields (X, y, sample_weight) self-play batches for fit_generator
+
+        The sign travels with the batch as a sample weight of 1 for won and -1
+        for lost games, since fit_generator queues batches ahead of training
+        and a learning rate set here would apply to some other batch.
+        - batches: iterable of play_batches() items, e.g. prefetched in a thread
+        """
+        for X, y, won in (self.play_batches() if batches is None else batches):
+            w = np.full(len(X), 1. if won else -1., dtype=np.float32)
+            yield X, y, [w] * len(y)
+
+    def play_batches(self):
+        """
+        Yields (X, [y_from, y_to], won) batches of won and lost self-play games
+        """
         self.boards = [chess.Board() for i in range(NUM_PARALLELL_GAMES)]
 
         self.white_states       = [[] for _ in range(NUM_PARALLELL_GAMES)]
@@ -141,6 +175,7 @@ class SelfPlayController:
 
         while True:
             # Play white move in all games
+            self.load_pending_weights()
             self.play_engine_move(self.white_engine, self.white_states, self.white_actions_from, self.white_actions_to)
             self.black_turn = not self.black_turn
             self.collect_game_results()
@@ -163,10 +198,7 @@ class SelfPlayController:
                 self.finished_win_actions_from = win_actions_from_shuffle[BATCH_SIZE:]
                 self.finished_win_actions_to   = win_actions_to_shuffle[BATCH_SIZE:]
 
-                learning_rate = abs(self.white_engine.model.optimizer.lr.get_value())
-                self.white_engine.model.optimizer.lr.set_value(learning_rate)
-
-                yield X_win, [y_from_win, y_to_win]
+                yield X_win, [y_from_win, y_to_win], True
 
             # Yield lost games
             while len(self.finished_lose_states) > BATCH_SIZE:
@@ -181,10 +213,7 @@ class SelfPlayController:
                 self.finished_lose_actions_from = lose_actions_from_shuffle[BATCH_SIZE:]
                 self.finished_lose_actions_to   = lose_actions_to_shuffle[BATCH_SIZE:]
 
-                learning_rate = abs(self.white_engine.model.optimizer.lr.get_value())
-                self.white_engine.model.optimizer.lr.set_value(-learning_rate)
-
-                yield X_lose, [y_from_lose, y_to_lose]
+                yield X_lose, [y_from_lose, y_to_lose], False
 
 def get_filename_for_saving():
     import time
@@ -198,7 +227,12 @@ def get_filename_for_saving():
     return folder_name + start_time + ".hdf5"
 
 def train(controller, engine):
-    from keras.callbacks import ModelCheckpoint
+    """
+    Trains engine.model on the self-play of controller
+    - engine: engine being trained, not the controller's white_engine since
+              self-play predicts in its own thread while this one trains
+    """
+    from keras.callbacks import ModelCheckpoint, LambdaCallback
 
     filename = get_filename_for_saving()
 
@@ -207,12 +241,21 @@ def train(controller, engine):
         verbose        = 2)
         # save_best_only = True)
 
-    engine.model.fit_generator(
-        controller.play_generator(),
-        samples_per_epoch = SAMPLES_PER_EPOCH,
-        nb_epoch          = NUMBER_EPOCHS,
-        callbacks         = [checkpointer],
-        verbose           = VERBOSE_LEVEL)
+    # Self-play plays with the trained weights as of the last epoch
+    controller.sync_weights(engine.model.get_weights())
+    syncer = LambdaCallback(on_epoch_end=lambda epoch, logs: controller.sync_weights(engine.model.get_weights()))
+
+    # Self-play shares the engines with the caller, so it runs ahead in a thread
+    batches = Prefetcher(lambda worker, num_workers: controller.play_batches(), threaded=True, report_every=100)
+    try:
+        engine.model.fit_generator(
+            controller.play_generator(batches),
+            samples_per_epoch = SAMPLES_PER_EPOCH,
+            nb_epoch          = NUMBER_EPOCHS,
+            callbacks         = [checkpointer, syncer],
+            verbose           = VERBOSE_LEVEL)
+    finally:
+        batches.close()
 
     if not os.path.isfile(filename):
         return None
@@ -221,6 +264,7 @@ def train(controller, engine):
 if __name__ == "__main__":
     white_model_hdf5 = "saved/sl_model.hdf5"
     white_engine = PolicyEngine(white_model_hdf5)
+    train_engine = PolicyEngine(white_model_hdf5)
 
     black_model_pool = [white_model_hdf5]
     while True:
@@ -229,7 +273,7 @@ if __name__ == "__main__":
 
         controller = SelfPlayController(white_engine, black_engine)
 
-        saved_model = train(controller, white_engine)
+        saved_model = train(controller, train_engine)
         if saved_model is not None:
             black_model_pool.append(saved_model)
             if len(black_model_pool) > SIZE_MODEL_POOL:
@@ -3,31 +3,32 @@ from data import Dataset
 from tqdm import tqdm
 
 
-def get_joint_accuracy(y_from, y_to, y_from_true, y_to_true):
-    num_top = 3
-    score = np.zeros((y_to.shape[0],))
-    for i in tqdm(range(y_to.shape[0])):
-        from_square_true = np.where(y_from_true[i] == 1)[0]
-        to_square_true = np.where(y_to_true[i] == 1)[0]
-        p = np.outer(y_from[i], y_to[i])
-        p_shape = p.shape
-        p = p.reshape((-1,))
+CHUNK_SIZE = 1024
 
-        for j, idx in enumerate(np.argsort(p)[::-1]):
-            if j >= num_top:
-                break
-            from_square, to_square = np.unravel_index(idx, p_shape)
-            if from_square == from_square_true and to_square == to_square_true:
-                score[i] = 1
-                break
+def get_joint_accuracy(y_from, y_to, from_true, to_true, num_top=3):
+    """
+    Prints the fraction of positions whose true move is among the num_top
+    most likely (from, to) pairs of the joint from x to probabilities
+    - from_true, to_true: integer square indices of the true moves
+    """
+    from_true = np.asarray(from_true).ravel()
+    to_true = np.asarray(to_true).ravel()
+    idx_true = from_true * y_to.shape[1] + to_true
+    score = np.zeros((y_to.shape[0],))
+    for i in tqdm(range(0, y_to.shape[0], CHUNK_SIZE)):
+        # Joint probabilities [N x 64*64] of a chunk of positions
+        p = (y_from[i:i+CHUNK_SIZE,:,None] * y_to[i:i+CHUNK_SIZE,None,:]).reshape(-1, y_from.shape[1] * y_to.shape[1])
+        top = np.argpartition(-p, num_top - 1, axis=1)[:,:num_top]
+        score[i:i+CHUNK_SIZE] = np.any(top == idx_true[i:i+CHUNK_SIZE,None], axis=1)
     print("Joint move accuracy: %f" % (score.sum() / score.shape[0]))
 
 if __name__ == '__main__':
     d_test = Dataset('data/small_test.pgn')
-    X_val, y_from_val, y_to_val = d_test.load(
+    X_val, [y_from_val, y_to_val] = d_test.load(
         'white_state_action_sl',
         featurized=True,
-        refresh=False)
+        refresh=False,
+        sparse=True)
     from keras.models import load_model
     model = load_model("./saved/policy/1481219504/94-4.61.hdf5")
     y_from, y_to = model.predict(X_val, verbose=1)
@@ -0,0 +1,156 @@
+import sys
+import time
+import queue
+import random
+import threading
+import traceback
+import multiprocessing
+import numpy as np
+
+MAX_QUEUE_SIZE = 16
+REPORT_EVERY = 1000  # batches between queue depth reports, 0 to disable
+POLL_TIMEOUT = 0.1
+JOIN_TIMEOUT = 5
+
+# Queue item kinds
+_BATCH = 0
+_DONE = 1
+_ERROR = 2
+
+def _produce(target, args, worker, num_workers, q, stop, seed):
+    """
+    Runs target(worker, num_workers, *args) and puts its batches on the queue until stopped
+    """
+    if seed is not None:
+        random.seed(seed + worker)
+        np.random.seed(seed + worker)
+    try:
+        for batch in target(worker, num_workers, *args):
+            while not stop.is_set():
+                try:
+                    q.put((_BATCH, batch), timeout=POLL_TIMEOUT)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set():
+                return
+        q.put((_DONE, None))
+    except:
+        q.put((_ERROR, "".join(traceback.format_exception(*sys.exc_info()))))
+
+class Prefetcher:
+    """
+    Runs a batch generator ahead of the consumer and hands out ready batches
+
+    The producers fill a bounded queue, so parsing and featurization overlap
+    with the model step. Errors in a producer are raised in the consumer and
+    close() stops the producers even when they are blocked on a full queue.
+    - target: target(worker, num_workers, *args) returns the generator of
+              each producer; module-level for processes so it can be pickled
+    - num_workers: number of producers
+    - threaded: run the producers in threads instead of processes, for
+                generators that share state with the caller like self-play
+    - seed: reseed random and np.random with seed + worker in each producer
+    - stats(): queue depth and the time the consumer spent waiting, where a
+               mostly empty queue means the data side is the bottleneck and
+               a mostly full one means the model side is
+    """
+    def __init__(self, target, args=(), num_workers=1, max_queue_size=MAX_QUEUE_SIZE,
+                 threaded=False, seed=None, report_every=REPORT_EVERY):
+        self.max_queue_size = max_queue_size
+        self.report_every = report_every
+        self.threaded = threaded
+        if threaded:
+            self.queue = queue.Queue(max_queue_size)
+            self.stop = threading.Event()
+            Worker = threading.Thread
+        else:
+            self.queue = multiprocessing.Queue(max_queue_size)
+            self.stop = multiprocessing.Event()
+            Worker = multiprocessing.Process
+
+        self.workers = []
+        for worker in range(num_workers):
+            w = Worker(target=_produce, args=(target, args, worker, num_workers, self.queue, self.stop, seed))
+            w.daemon = True
+            w.start()
+            self.workers.append(w)
+        self.num_running = num_workers
+
+        self.num_batches = 0
+        self.sum_depth = 0
+        self.num_empty = 0
+        self.wait_time = 0.
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self.num_running > 0:
+            depth = self._depth()
+            if depth == 0:
+                self.num_empty += 1
+            t = time.time()
+            kind, item = self.queue.get()
+            self.wait_time += time.time() - t
+
+            if kind == _BATCH:
+                self.num_batches += 1
+                self.sum_depth += depth
+                if self.report_every and self.num_batches % self.report_every == 0:
+                    self.report()
+                return item
+            elif kind == _DONE:
+                self.num_running -= 1
+            else:
+                self.close()
+                raise RuntimeError("Prefetch worker failed:\n" + item)
+        self.close()
+        raise StopIteration
+
+    def _depth(self):
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            # multiprocessing.Queue.qsize is not available on macOS
+            return -1
+
+    def stats(self):
+        """
+        Returns the mean queue depth, the fraction of batches that found the
+        queue empty and the total time spent waiting for batches
+        """
+        num_batches = max(self.num_batches, 1)
+        return {
+            "batches": self.num_batches,
+            "mean_depth": self.sum_depth / num_batches,
+            "max_depth": self.max_queue_size,
+            "empty": self.num_empty / num_batches,
+            "wait_time": self.wait_time
+        }
+
+    def report(self):
+        stats = self.stats()
+        stats["empty"] *= 100
+        print("\nPrefetch queue: depth %(mean_depth).1f/%(max_depth)d, empty %(empty).0f%%, "
+              "waited %(wait_time).1fs over %(batches)d batches" % stats)
+
+    def close(self):
+        """
+        Stops the producers and waits for them to exit
+        """
+        self.stop.set()
+        for w in self.workers:
+            if self.threaded:
+                # Threads exit at their next batch, daemon threads left running die with the process
+                w.join(JOIN_TIMEOUT)
+            else:
+                # Unblock producers stuck putting on a full queue
+                w.terminate()
+                w.join()
+        self.workers = []
+        self.num_running = 0
+
+    def __del__(self):
+        if self.workers:
+            self.close()
@@ -0,0 +1,104 @@
+import os
+import numpy as np
+import data
+
+class PackedReader:
+    """
+    Memory-mapped reader over the packed (sharded) cache of a Dataset generator
+
+    Positions and labels stay on disk and only the sampled batches are read
+    and unpacked, so resident memory does not grow with the corpus size.
+    """
+    def __init__(self, dataset, generator):
+        folder, manifest = dataset.load_manifest(generator)
+        shards = [shard for shard in manifest["shards"] if shard["num_positions"] > 0]
+        self.positions = [np.load(os.path.join(folder, shard["positions"]), mmap_mode="r") for shard in shards]
+        self.labels = [np.load(os.path.join(folder, shard["labels"]), mmap_mode="r") for shard in shards]
+        self.offsets = np.cumsum([0] + [shard["num_positions"] for shard in shards])
+        self.generator_name = generator
+        self.stored = manifest["generator"]
+        self.value = generator in data.VALUE_GENERATORS
+        self.targets = generator in data.TARGET_GENERATORS
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def read(self, indices):
+        """
+        Returns the packed (positions, labels) at the given global indices
+        """
+        indices = np.asarray(indices)
+        positions = np.empty(indices.shape, dtype=data.POSITION_DTYPE)
+        labels = np.empty(indices.shape, dtype=self.labels[0].dtype if self.labels else np.uint16)
+        shards = np.searchsorted(self.offsets, indices, side="right") - 1
+        for shard in np.unique(shards):
+            mask = shards == shard
+            local = indices[mask] - self.offsets[shard]
+            positions[mask] = self.positions[shard][local]
+            labels[mask] = self.labels[shard][local]
+        return positions, data.packed_labels(labels, self.stored, self.generator_name)
+
+    def batch(self, indices, featurized=True, board="both", sparse=False):
+        """
+        Returns (X, y) for the given global indices as yielded by the generator
+        - board: board type, or heads as in data.unpack_targets for state_targets
+        - sparse: integer class indices instead of one-hot move labels
+        """
+        positions, labels = self.read(indices)
+        S = data.unpack_positions(positions, featurized=featurized)
+        if self.targets:
+            return data.unpack_targets(S, labels, targets=board, sparse=sparse)
+        if self.value:
+            return S, labels
+        return data.unpack_actions(S, labels, board=board, sparse=sparse)
+
+    def generator(self, batch_size=32, featurized=True, board="both", shuffle=True, loop=True, sparse=False,
+                  worker=0, num_workers=1, seed=None):
+        """
+        Yields (X, y) batches for fit_generator
+        - shuffle: visit the positions in a new random order every epoch
+        - worker, num_workers: yield only every num_workers-th position of each
+                               epoch's order from the worker-th, so that the
+                               workers together cover one epoch per epoch
+        - seed: seed of the epoch orders, seed + epoch, shared by the workers
+        """
+        if shuffle and num_workers > 1 and seed is None:
+            raise ValueError("Workers sharing an epoch need a shared shuffle seed")
+        epoch = 0
+        while True:
+            if not shuffle:
+                order = np.arange(len(self))
+            elif seed is None:
+                order = np.random.permutation(len(self))
+            else:
+                order = np.random.RandomState((seed + epoch) % 2**32).permutation(len(self))
+            order = order[worker::num_workers]
+            epoch += 1
+            for i in range(0, len(order), batch_size):
+                # Sorted reads keep memory-mapped access sequential within a shard
+                yield self.batch(np.sort(order[i:i+batch_size]), featurized=featurized, board=board, sparse=sparse)
+            if not loop:
+                break
+
+def open_packed(dataset, generator, refresh=False, num_workers=1):
+    """
+    Returns a PackedReader for the generator, building its packed cache if missing
+    """
+    if not refresh:
+        try:
+            return PackedReader(dataset, generator)
+        except IOError:
+            pass
+    dataset.pickle_packed(generator, num_workers=num_workers)
+    return PackedReader(dataset, generator)
+
+def packed_batches(worker, num_workers, filename, generator, batch_size=32, featurized=True, board="both", sparse=False,
+                   games=None, seed=0):
+    """
+    Prefetcher target yielding the worker's share of the batches of an existing packed cache, opened in the worker
+    - games: game offsets or offsets filename of the dataset as in Dataset
+    - seed: shuffle seed, the same for every worker
+    """
+    return PackedReader(data.Dataset(filename, games=games), generator).generator(batch_size, featurized=featurized,
+                                                                     board=board, sparse=sparse, worker=worker,
+                                                                     num_workers=num_workers, seed=seed)
@@ -1,17 +1,62 @@
 import os
 from tqdm import tqdm
 import argparse
+import numpy as np
+import compressed
+import pgn_index
 
 size_test = 200
 
+SPLITS = ("train", "val", "test")
+RATIOS = (0.9, 0.05, 0.05)
+
+def split_filename(filename, split):
+    return filename + "." + split + ".npy"
+
+def hash_offsets(offsets, seed=0):
+    """
+    Returns uniform uint64 hashes of game offsets (splitmix64 finalizer)
+    """
+    with np.errstate(over="ignore"):
+        h = np.asarray(offsets, dtype=np.uint64) + np.uint64(seed) * np.uint64(0x9e3779b97f4a7c15)
+        h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        return h ^ (h >> np.uint64(31))
+
+def split_index(filename, ratios=RATIOS, seed=0, refresh=False):
+    """
+    Splits the games of a PGN into train/val/test by hashing their offsets in the game index
+    - writes the offsets of each split to filename.<split>.npy without touching
+      the PGN, for Dataset(filename, games=split_filename(filename, split))
+    - a game stays in its split when ratios are unchanged and games are appended
+    - returns {split: offsets filename}
+    """
+    offsets = pgn_index.load_index(filename, refresh=refresh)["offset"]
+    ratios = np.asarray(ratios, dtype=np.float64)
+    bounds = np.cumsum(ratios / ratios.sum())[:-1]
+    u = (hash_offsets(offsets, seed=seed) >> np.uint64(11)).astype(np.float64) / 2.**53
+    buckets = np.searchsorted(bounds, u, side="right")
+
+    filenames = {}
+    for i, split in enumerate(SPLITS[:len(ratios)]):
+        filenames[split] = split_filename(filename, split)
+        np.save(filenames[split], offsets[buckets == i])
+        print("%s: %d games" % (split, np.count_nonzero(buckets == i)))
+    return filenames
+
 def split(filename):
-    name, ext = os.path.splitext(filename)
+    """
+    Rewrites the PGN into _train and _test files, superseded by split_index
+    """
+    # Outputs keep the compression of the input, e.g. games.pgn.gz -> games_train.pgn.gz
+    name, ext = os.path.splitext(compressed.strip_compression(filename))
+    ext += filename[len(compressed.strip_compression(filename)):]
     train_filename = name + "_train" + ext
     test_filename = name + "_test" + ext
 
-    with open(filename) as f:
-        with open(train_filename, "w") as f_train:
-            with open(test_filename, "w") as f_test:
+    with compressed.open_input(filename) as f:
+        with compressed.open_output(train_filename) as f_train:
+            with compressed.open_output(test_filename) as f_test:
                 idx_game = 0
                 for line in tqdm(f):
                     if not line.strip():
@@ -39,5 +84,11 @@ def split(filename):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("filename", help="file to split")
+    parser.add_argument("-r", "--ratios", type=float, nargs=3, default=RATIOS, help="train, val and test ratios. Default: %s" % " ".join(map(str, RATIOS)))
+    parser.add_argument("-s", "--seed", type=int, default=0, help="Hash seed, change to draw another split")
+    parser.add_argument("--rewrite", action="store_true", help="Copy the games into _train and _test PGNs instead")
     args = parser.parse_args()
-    split(args.filename)
+    if args.rewrite:
+        split(args.filename)
+    else:
+        split_index(args.filename, ratios=args.ratios, seed=args.seed)
@@ -0,0 +1,259 @@
+import os
+import re
+import time
+import argparse
+import multiprocessing
+import chess
+import chess.uci
+import numpy as np
+import data
+import compressed
+
+BATCH_SIZE = 1024
+MOVE_TIME = 100  # milliseconds per position for UCI engines
+NUM_WORKERS = os.cpu_count() or 1
+
+# Every legal move of every position of a suite, sorted by position then move
+# - row: position in the suite
+# - move: (from * 64 + to) index from the side to move's perspective as in flip_state
+# - points: STS points awarded for the move, 0 if none
+STS_MOVE_DTYPE = np.dtype([("row", "<u4"),
+                           ("move", "<u2"),
+                           ("points", "u1")])
+
+def sts_files(paths):
+    """
+    Returns the EPD files of the given files and folders, ordered by suite number
+    """
+    filenames = []
+    for path in paths:
+        if not os.path.isdir(path):
+            filenames.append(path)
+            continue
+        for filename in os.listdir(path):
+            if compressed.strip_compression(filename).lower().endswith(".epd"):
+                filenames.append(os.path.join(path, filename))
+    # STS2 before STS10
+    return sorted(filenames, key=lambda f: [int(s) if s.isdigit() else s for s in re.split(r"(\d+)", f)])
+
+def build_sts(dataset):
+    """
+    Saves the positions and scored legal moves of an STS file as an entry of the dataset cache
+    - positions are flipped to the side to move like the training caches
+    """
+    positions = []
+    black = []
+    ids = []
+    moves = []
+    for row, (board, id_test, scores) in enumerate(data.read_sts(dataset.filename)):
+        is_black = board.turn == chess.BLACK
+        positions.append(data.position_from_board(board, black=is_black))
+        black.append(is_black)
+        ids.append(id_test or "")
+
+        # Promotions share an index, so keep the best points among them
+        points = {}
+        for move in board.legal_moves:
+            idx = data.index_from_move(move, black=is_black)
+            points[idx] = max(points.get(idx, 0), scores.get(move, 0))
+        moves.extend((row, idx, p) for idx, p in sorted(points.items()))
+
+    source = dataset.cache.source_hash(dataset.filename)
+    params = dataset.cache_params("sts")
+    folder = dataset.cache.create(source, params)
+    np.save(os.path.join(folder, "sts-positions.npy"), np.array(positions, dtype=data.POSITION_DTYPE))
+    np.save(os.path.join(folder, "sts-black.npy"), np.array(black, dtype=bool))
+    np.save(os.path.join(folder, "sts-ids.npy"), np.array(ids, dtype=np.str_))
+    np.save(os.path.join(folder, "sts-moves.npy"), np.array(moves, dtype=STS_MOVE_DTYPE))
+    dataset.cache.add(source, params)
+    return folder
+
+def open_sts(filename, refresh=False):
+    """
+    Returns the cache folder of an STS file, building it if missing
+    """
+    dataset = data.Dataset(filename)
+    folder = None
+    if not refresh:
+        source = dataset.cache.source_hash(dataset.filename)
+        folder, _ = dataset.cache.lookup(source, [dataset.cache_params("sts")])
+    if folder is None:
+        folder = build_sts(dataset)
+    return folder
+
+class StsSuite:
+    """
+    Cached positions of one STS file with the points of every legal move
+    """
+    def __init__(self, folder, filename=None):
+        self.positions = np.load(os.path.join(folder, "sts-positions.npy"))
+        self.black = np.load(os.path.join(folder, "sts-black.npy"))
+        self.ids = np.load(os.path.join(folder, "sts-ids.npy"))
+        self.moves = np.load(os.path.join(folder, "sts-moves.npy"))
+        self.name = suite_name(self.ids, filename)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def boards(self):
+        return data.boards_from_positions(self.positions, black=self.black)
+
+    def max_points(self):
+        """
+        Returns the points of a perfect score, the best move of every position
+        """
+        max_points = np.zeros(len(self), dtype=np.int64)
+        np.maximum.at(max_points, self.moves["row"].astype(np.intp), self.moves["points"])
+        return int(max_points.sum())
+
+    def picks_from_moves(self, moves):
+        """
+        Returns the rows of self.moves of one chosen move index per position, -1 if illegal or None
+        """
+        moves = np.array([-1 if move is None else move for move in moves], dtype=np.int64)
+        keys = self.moves["row"].astype(np.int64) * data.NUM_SQUARES * data.NUM_SQUARES + self.moves["move"]
+        queries = np.arange(len(self), dtype=np.int64) * data.NUM_SQUARES * data.NUM_SQUARES + moves
+        picks = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+        return np.where((moves >= 0) & (keys[picks] == queries), picks, -1)
+
+    def score(self, picks):
+        """
+        Returns (points, number of best moves found) of the picked rows of self.moves
+        """
+        picks = np.asarray(picks)
+        points = np.where(picks >= 0, self.moves["points"][np.maximum(picks, 0)].astype(np.int64), 0)
+        best = np.zeros(len(self), dtype=np.int64)
+        np.maximum.at(best, self.moves["row"].astype(np.intp), self.moves["points"])
+        return int(points.sum()), int(np.count_nonzero((points == best) & (points > 0)))
+
+def suite_name(ids, filename=None):
+    """
+    Returns the suite name from its test ids, e.g. "Undermining" from "STS(v1.0) Undermining.001"
+    """
+    for id_test in ids:
+        matches = re.match(r"(?:STS\S*\s+)?(.*?)\.\d+$", str(id_test))
+        if matches is not None:
+            return matches.group(1)
+    return os.path.basename(compressed.strip_compression(filename)) if filename else ""
+
+def policy_picks(model, suite, featurized=True, batch_size=BATCH_SIZE):
+    """
+    Returns the rows of suite.moves of the most likely legal move of every
+    position under a from/to policy model, predicted in batches
+    """
+    X = data.unpack_positions(suite.positions, featurized=featurized)
+    y_from, y_to = model.predict(X, batch_size=batch_size, verbose=0)
+
+    # Joint probability of every legal move, then the best one of each position
+    rows = suite.moves["row"].astype(np.intp)
+    moves = suite.moves["move"].astype(np.intp)
+    p = y_from[rows, moves // data.NUM_SQUARES] * y_to[rows, moves % data.NUM_SQUARES]
+    order = np.lexsort((-p, rows))
+    _, idx_first = np.unique(rows[order], return_index=True)
+    picks = np.full(len(suite), -1, dtype=np.int64)
+    picks[rows[order[idx_first]]] = order[idx_first]
+    return picks
+
+def engine_picks(path_engine, suite, move_time=MOVE_TIME):
+    """
+    Returns the rows of suite.moves of the moves chosen by a UCI engine given move_time per position
+    """
+    engine = chess.uci.popen_engine(path_engine)
+    try:
+        engine.uci()
+        moves = []
+        for board, black in zip(suite.boards(), suite.black):
+            engine.ucinewgame()
+            engine.position(board)
+            move = engine.go(movetime=move_time).bestmove
+            moves.append(None if move is None or not board.is_legal(move) else data.index_from_move(move, black=black))
+    finally:
+        engine.quit()
+    return suite.picks_from_moves(moves)
+
+_model = None
+
+def _init_worker(model_hdf5):
+    """
+    Loads the policy model once per worker process
+    """
+    global _model
+    if model_hdf5 is not None:
+        from keras.models import load_model
+        _model = load_model(model_hdf5)
+
+def _run_suite(job):
+    folder, filename, path_engine, move_time, featurized, batch_size = job
+    suite = StsSuite(folder, filename)
+    t = time.time()
+    if path_engine is None:
+        picks = policy_picks(_model, suite, featurized=featurized, batch_size=batch_size)
+    else:
+        picks = engine_picks(path_engine, suite, move_time=move_time)
+    points, num_best = suite.score(picks)
+    return {
+        "file": filename,
+        "name": suite.name,
+        "positions": len(suite),
+        "points": points,
+        "max_points": suite.max_points(),
+        "best": num_best,
+        "time": time.time() - t
+    }
+
+def run_sts(paths, model_hdf5=None, path_engine=None, move_time=MOVE_TIME, featurized=True,
+            batch_size=BATCH_SIZE, num_workers=NUM_WORKERS, refresh=False):
+    """
+    Scores a policy model or UCI engine on STS files and prints the points per suite
+    - paths: EPD files or folders of them
+    - model_hdf5: from/to policy model, used if path_engine is None
+    - num_workers: suites are scored in a process pool
+    """
+    filenames = sts_files(paths)
+    # Caches are built here so the workers never write the cache manifest at once
+    jobs = [(open_sts(filename, refresh=refresh), filename, path_engine, move_time, featurized, batch_size) \
+            for filename in filenames]
+
+    t = time.time()
+    num_workers = max(1, min(num_workers, len(jobs)))
+    if num_workers <= 1:
+        _init_worker(model_hdf5 if path_engine is None else None)
+        results = [_run_suite(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                    initargs=(model_hdf5 if path_engine is None else None,))
+        try:
+            results = pool.map(_run_suite, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    wall_time = time.time() - t
+
+    print("%-40s %9s %6s %5s %8s" % ("Suite", "Points", "%", "Best", "Time"))
+    for result in results:
+        print("%-40s %4d/%4d %6.1f %5d %7.1fs" % ((os.path.basename(result["file"]) + " " + result["name"])[:40],
+              result["points"], result["max_points"], 100. * result["points"] / max(result["max_points"], 1),
+              result["best"], result["time"]))
+    points = sum(result["points"] for result in results)
+    max_points = sum(result["max_points"] for result in results)
+    num_positions = sum(result["positions"] for result in results)
+    print("%-40s %4d/%4d %6.1f %5d %7.1fs" % ("Total", points, max_points, 100. * points / max(max_points, 1),
+          sum(result["best"] for result in results), wall_time))
+    print("%d positions in %.1fs (%.1f positions/s)" % (num_positions, wall_time, num_positions / max(wall_time, 1e-9)))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="STS EPD files or folders of them")
+    parser.add_argument("-m", "--model", help="From/to policy model (hdf5)")
+    parser.add_argument("-e", "--engine", help="UCI engine executable, scored instead of a model")
+    parser.add_argument("-t", type=int, default=MOVE_TIME, help="Engine time per position in milliseconds. Default: %dms" % MOVE_TIME)
+    parser.add_argument("-b", type=int, default=BATCH_SIZE, help="Model batch size. Default: %d" % BATCH_SIZE)
+    parser.add_argument("-j", type=int, default=NUM_WORKERS, help="Suites scored in parallel. Default: %d" % NUM_WORKERS)
+    parser.add_argument("--unfeaturized", action="store_true", help="Model takes the 12 piece planes only")
+    parser.add_argument("--refresh", action="store_true", help="Rebuild the STS caches")
+    args = parser.parse_args()
+    if (args.model is None) == (args.engine is None):
+        parser.error("Pass exactly one of --model and --engine")
+    run_sts(args.paths, model_hdf5=args.model, path_engine=args.engine, move_time=args.t,
+            featurized=not args.unfeaturized, batch_size=args.b, num_workers=args.j, refresh=args.refresh)
@@ -0,0 +1,88 @@
+import chess
+import numpy as np
+import pytest
+import data
+
+def test_read_sts_promotions(tmp_path):
+    filename = str(tmp_path / "sts.epd")
+    with open(filename, "w") as f:
+        f.write('4k3/P7/8/8/8/8/8/4K3 w - - bm a8=Q; id "STS(v1.0) Promotion.001"; c0 "a8=Q=10, a8=R=3, Kd2=1";\n')
+    [(board, id_test, scores)] = list(data.read_sts(filename))
+    assert id_test == "STS(v1.0) Promotion.001"
+    assert scores == {
+        chess.Move.from_uci("a7a8q"): 10,
+        chess.Move.from_uci("a7a8r"): 3,
+        chess.Move.from_uci("e1d2"): 1
+    }
+
+FENS = [
+    chess.STARTING_FEN,
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3",
+    "r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP1B1PPP/R2QKB1R b KQ - 3 8",
+    "8/2k5/3q4/8/3B4/8/1Q3K2/4R3 b - - 0 1",
+]
+
+# (piece type, ray directions) of the rook, bishop and queen slider planes
+REFERENCE_SLIDERS = (
+    (chess.ROOK, ((1, 0), (0, 1), (-1, 0), (0, -1))),
+    (chess.BISHOP, ((1, 1), (-1, 1), (-1, -1), (1, -1))),
+    (chess.QUEEN, ((1, 0), (0, 1), (-1, 0), (0, -1), (1, 1), (-1, 1), (-1, -1), (1, -1))),
+)
+
+def reference_state(board, featurized, black):
+    """
+    Builds the state square by square from board.piece_at
+    """
+    # (color, piece type) by (row, col) from the side's perspective, color 0 for the side
+    pieces = {}
+    for square in chess.SQUARES:
+        piece = board.piece_at(square)
+        if piece is not None:
+            row = 7 - chess.square_rank(square) if black else chess.square_rank(square)
+            color = 0 if piece.color == (chess.BLACK if black else chess.WHITE) else 1
+            pieces[(row, chess.square_file(square))] = (color, piece.piece_type)
+
+    state = np.zeros((data.NUM_FEATURE_CHANNELS if featurized else 12, 8, 8))
+    for (row, col), (color, piece_type) in pieces.items():
+        state[6 * color + piece_type - 1, row, col] = 1
+    if not featurized:
+        return state
+
+    for idx_slider, (slider_type, directions) in enumerate(REFERENCE_SLIDERS):
+        for (row, col), (color, piece_type) in pieces.items():
+            if piece_type != slider_type:
+                continue
+            for d_row, d_col in directions:
+                r, c = row + d_row, col + d_col
+                while 0 <= r < 8 and 0 <= c < 8 and (r, c) not in pieces:
+                    r, c = r + d_row, c + d_col
+                if 0 <= r < 8 and 0 <= c < 8:
+                    defends = pieces[(r, c)][0] == color
+                    plane = (0 if defends else 1) if color == 0 else (3 if defends else 2)
+                    state[12 + 4 * idx_slider + plane, r, c] += 1
+    for (row, col), (color, _) in pieces.items():
+        state[24 + color, row, col] = 1
+    state[26] = 1 - state[24] - state[25]
+    return state
+
+@pytest.mark.parametrize("fen", FENS)
+@pytest.mark.parametrize("black", [False, True])
+@pytest.mark.parametrize("featurized", [False, True])
+def test_state_matches_reference(fen, black, featurized):
+    board = chess.Board(fen)
+    state = data.state_from_board(board, featurized=featurized, black=black)
+    assert state.shape == (27 if featurized else 12, 8, 8)
+    assert np.array_equal(state, reference_state(board, featurized, black))
+
+    batch = data.featurize_boards([board, board], black=[black, not black], featurized=featurized)
+    assert np.array_equal(batch[0], state)
+    assert np.array_equal(batch[1], reference_state(board, featurized, not black))
+
+@pytest.mark.parametrize("fen", FENS)
+@pytest.mark.parametrize("black", [False, True])
+def test_board_from_state_round_trip(fen, black):
+    board = chess.Board(fen)
+    restored = data.board_from_state(data.state_from_board(board, black=black), black=black)
+    assert restored.board_fen() == (board.mirror() if black else board).board_fen()
+    assert restored.turn == (not black)
@@ -0,0 +1,36 @@
+import os
+import shutil
+import numpy as np
+import pytest
+from data import Dataset
+from reader import open_packed
+
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+
+def open_reader(tmp_path):
+    # Copy the PGN so the index and cache are built in the temporary folder
+    filename = str(tmp_path / "small_test.pgn")
+    shutil.copy(os.path.join(DATA_FOLDER, "small_test.pgn"), filename)
+    reader = open_packed(Dataset(filename), "state_action_sl")
+    reader.batch = lambda indices, **kwargs: indices
+    return reader
+
+def test_workers_cover_one_epoch(tmp_path):
+    reader = open_reader(tmp_path)
+    num_workers = 3
+    epochs = []
+    for worker in range(num_workers):
+        batches = reader.generator(batch_size=32, worker=worker, num_workers=num_workers, seed=7)
+        num_batches = -(-len(range(worker, len(reader), num_workers)) // 32)
+        epochs.append([np.concatenate([next(batches) for _ in range(num_batches)]) for _ in range(2)])
+
+    for epoch in range(2):
+        seen = np.concatenate([worker_epochs[epoch] for worker_epochs in epochs])
+        assert np.array_equal(np.sort(seen), np.arange(len(reader)))
+    # A new order every epoch
+    assert not np.array_equal(epochs[0][0], epochs[0][1])
+
+def test_sharded_shuffle_needs_seed(tmp_path):
+    reader = open_reader(tmp_path)
+    with pytest.raises(ValueError):
+        next(reader.generator(worker=0, num_workers=2))
@@ -2,6 +2,10 @@ import numpy as np
 import os
 import time
 from data import Dataset
+from reader import open_packed, packed_batches
+from dedup import open_dedup, dedup_batches
+from prefetch import Prefetcher
+from split_data import split_filename
 
 np.random.seed(20)
 
@@ -9,6 +13,8 @@ FOLDER_TO_SAVE = "./saved/"
 NUMBER_EPOCHS = 10000  # some large number
 SAMPLES_PER_EPOCH = 12800  # tune for feedback/speed balance
 VERBOSE_LEVEL = 1
+BATCH_SIZE = 32
+NUM_WORKERS = os.cpu_count() or 1  # processes for building dataset caches and prefetching batches
 
 def get_folder_name(start_time, net_type):
     folder_name = FOLDER_TO_SAVE + net_type + '/' + start_time
@@ -67,18 +73,47 @@ def dense_wrap(params, dense_out, i):
     return dense_out
 
 
-def train(net_type, generator_fn_str, dataset_file, build_net_fn, featurized=True):
-    d = Dataset(dataset_file + 'train.pgn')
-    generator_fn = getattr(d, generator_fn_str)
-    d_test = Dataset(dataset_file + 'test.pgn')
-
-    X_val, y_val = d_test.load(generator_fn.__name__,
-        featurized = featurized,
-        refresh    = False,
-        board = net_type)
-
-    board_num_channels = X_val[0].shape[1] if net_type == 'to' else X_val[0].shape[0]
+def split_datasets(dataset_file, splits, split=False):
+    """
+    Returns (filename, games) of each split
+    - split: dataset_file is one PGN with offset lists from split_data.split_index,
+             otherwise the prefix of separate <split>.pgn files
+    """
+    if split:
+        return [(dataset_file, split_filename(dataset_file, s)) for s in splits]
+    return [(dataset_file + s + '.pgn', None) for s in splits]
+
+def train(net_type, generator_fn_str, dataset_file, build_net_fn, featurized=True, dedup=False, sparse=False, split=False):
+    """
+    - dedup: train on unique positions with aggregated targets (state_action_sl and state_value only)
+    - sparse: train move heads on integer labels with sparse_categorical_crossentropy
+    - split: train and validate on the train and val offset lists of one PGN
+    """
+    assert not (dedup and sparse), "dedup targets are move distributions, not single labels"
+    # The dedup store holds the plies of both colours, flipped to the side to move
+    assert not dedup or generator_fn_str in ("state_action_sl", "state_value"), \
+        "dedup serves state_action_sl and state_value only, not " + generator_fn_str
+    # Memory-mapped readers over the packed caches, built once from the PGNs
+    (filename_train, games_train), (filename_val, games_val) = \
+        split_datasets(dataset_file, ('train', 'val') if split else ('train', 'test'), split=split)
+    reader = open_packed(Dataset(filename_train, games=games_train), generator_fn_str, num_workers=NUM_WORKERS)
+    # Training batches are unpacked and featurized in worker processes ahead of the model
+    if dedup:
+        open_dedup(Dataset(filename_train, games=games_train), num_workers=NUM_WORKERS)
+        generator = Prefetcher(dedup_batches, args=(filename_train, BATCH_SIZE, featurized, net_type, reader.value, 1.0, games_train),
+                               num_workers=NUM_WORKERS, seed=20)
+    else:
+        # The workers share one shuffle per epoch and each yields its slice of it
+        generator = Prefetcher(packed_batches, args=(filename_train, generator_fn_str, BATCH_SIZE, featurized, net_type, sparse, games_train,
+                                                     np.random.randint(2**31)),
+                               num_workers=NUM_WORKERS, seed=20)
+    reader_val = open_packed(Dataset(filename_val, games=games_val), generator_fn_str, num_workers=NUM_WORKERS)
+
+    X_val, y_val = reader_val.batch([0], featurized=featurized, board=net_type)
+    board_num_channels = X_val[0].shape[1] if net_type == 'to' else X_val.shape[1]
     model = build_net_fn(board_num_channels=board_num_channels, net_type=net_type)
+    if sparse and not reader.value:
+        model.compile(model.optimizer, 'sparse_categorical_crossentropy', metrics=['accuracy'])
     start_time = str(int(time.time()))
     try:
         plot_model(model, start_time, net_type)
@@ -90,46 +125,48 @@ def train(net_type, generator_fn_str, dataset_file, build_net_fn, featurized=Tru
         verbose        = 2,
         save_best_only = True)
 
-    model.fit_generator(generator_fn(featurized=featurized, board=net_type),
-        samples_per_epoch = SAMPLES_PER_EPOCH,
-        nb_epoch          = NUMBER_EPOCHS,
-        callbacks         = [checkpointer],
-        validation_data   = (X_val, y_val),
-        verbose           = VERBOSE_LEVEL)
-
-def validate(model_hdf5, net_type, generator_fn_str, dataset_file, featurized=True):
+    try:
+        model.fit_generator(generator,
+            samples_per_epoch = SAMPLES_PER_EPOCH,
+            nb_epoch          = NUMBER_EPOCHS,
+            callbacks         = [checkpointer],
+            validation_data   = reader_val.generator(BATCH_SIZE, featurized=featurized, board=net_type, shuffle=False, sparse=sparse),
+            nb_val_samples    = len(reader_val),
+            verbose           = VERBOSE_LEVEL)
+    finally:
+        generator.close()
+
+def validate(model_hdf5, net_type, generator_fn_str, dataset_file, featurized=True, split=False):
     from keras.models import load_model
     import data
 
-    d_test = Dataset(dataset_file + 'test.pgn')
-    X_val, y_val = d_test.load(generator_fn_str,
+    [(filename_test, games_test)] = split_datasets(dataset_file, ('test',), split=split)
+    d_test = Dataset(filename_test, games=games_test)
+    X_val, [from_val, to_val] = d_test.load(generator_fn_str,
         featurized = featurized,
         refresh    = False,
-        board      = "both")
-    boards = data.board_from_state(X_val)
+        board      = "both",
+        sparse     = True)
+    from_val = from_val.ravel()
+    to_val = to_val.ravel()
 
     if net_type == "from":
         model_from = load_model("saved/" + model_hdf5)
         y_hat_from = model_from.predict(X_val)
-        num_correct = 0
-        for i in range(len(boards)):
-            if y_val[0][i,np.argmax(y_hat_from[i])] > 0:
-                num_correct += 1
-        print(num_correct / len(boards))
+        print(np.mean(np.argmax(y_hat_from, axis=1) == from_val))
 
     elif net_type == "to":
         model_to = load_model("saved/" + model_hdf5)
-        y_hat_to = model_to.predict([X_val, y_val[0].reshape(y_val[0].shape[0],1,X_val.shape[2],X_val.shape[3])])
-        num_correct = 0
-        for i in range(len(boards)):
-            if y_val[1][i,np.argmax(y_hat_to[i])] > 0:
-                num_correct += 1
-        print(num_correct / len(boards))
+        from_planes = np.zeros((len(from_val), X_val.shape[2] * X_val.shape[3]), dtype=np.float32)
+        from_planes[np.arange(len(from_val)), from_val] = 1
+        y_hat_to = model_to.predict([X_val, from_planes.reshape(-1,1,X_val.shape[2],X_val.shape[3])])
+        print(np.mean(np.argmax(y_hat_to, axis=1) == to_val))
 
     elif net_type == "from_to":
         model_from = load_model("saved/" + model_hdf5[0])
         model_to = load_model("saved/" + model_hdf5[1])
         y_hat_from = model_from.predict(X_val)
+        boards = data.board_from_state(X_val)
 
         for i in range(len(boards)):
             from_square = np.argmax(y_hat_from[i])
@@ -144,5 +181,5 @@ def validate(model_hdf5, net_type, generator_fn_str, dataset_file, featurized=Tr
             else:
                 print("BOO")
             print(move_attempt)
-            move = data.move_from_action(np.argmax(y_val[0]), np.argmax(y_val[1]))
+            move = data.move_from_action(int(from_val[i]), int(to_val[i]))
             print(move)